@@ -4,6 +4,7 @@
 """
 
 import logging
+import threading
 
 import collections
 from collections import defaultdict
@@ -35,14 +36,145 @@ def get_jids_in_group(xmlnode, group):
     return jids
 
 
+class _Node(object):
+    """ A node of DomainIndex: one domain label."""
+    __slots__ = ('children', 'value', 'users')
+
+    def __init__(self):
+        self.children = {}
+        self.value = None
+        self.users = {}
+
+
+class DomainIndex(object):
+    """ Maps jids and domains to values, stored as a trie of domain labels
+        from the top-level domain down. An address is looked up walking its
+        labels once, without building the suffixes generated by parts_of.
+        Values must not be None.
+    """
+
+    def __init__(self):
+        self.__root = _Node()
+
+    def __node(self, domain, create):
+        node = self.__root
+        pos = len(domain)
+        while node is not None:
+            dot = domain.rfind('.', 0, pos)
+            label = domain[dot + 1:pos]
+            child = node.children.get(label)
+            if child is None and create:
+                child = node.children[label] = _Node()
+            node = child
+            if dot < 0:
+                break
+            pos = dot
+        return node
+
+    def __setitem__(self, address, value):
+        (local, at, domain) = address.partition('@')
+        if not at:
+            domain = local
+        node = self.__node(domain, True)
+        if at:
+            node.users[local] = value
+        else:
+            node.value = value
+
+    def __delitem__(self, address):
+        (local, at, domain) = address.partition('@')
+        if not at:
+            domain = local
+        node = self.__node(domain, False)
+        if node is None:
+            raise KeyError(address)
+        if at:
+            del node.users[local]
+        elif node.value is None:
+            raise KeyError(address)
+        else:
+            node.value = None
+
+    def clear(self):
+        self.__root = _Node()
+
+    def find(self, address, accept = None):
+        """ Returns a tuple (part, value) for the most specific of parts_of(address)
+            in the index whose value is in accept, or (None, None).
+                address -- jid or domain
+                accept  -- collection of accepted values (default None, any value)
+        """
+        at = address.find('@')
+        node = self.__root
+        pos = len(address)
+        best = None
+        while True:
+            dot = max(address.rfind('.', at + 1, pos), at)
+            node = node.children.get(address[dot + 1:pos])
+            if node is None:
+                break
+            if dot == at:
+                if at < 0:
+                    if node.value is not None and (accept is None or node.value in accept):
+                        return (address, node.value)
+                    break
+                value = node.users.get(address[:at])
+                if value is not None and (accept is None or value in accept):
+                    return (address, value)
+            if at >= 0 and node.value is not None and (accept is None or node.value in accept):
+                best = (dot + 1, node.value)
+            if dot == at:
+                break
+            pos = dot
+        if best is None:
+            return (None, None)
+        return (address[best[0]:], best[1])
+
+    def find_all(self, address):
+        """ Returns a list with the values of all parts_of(address) in the index.
+        """
+        at = address.find('@')
+        node = self.__root
+        pos = len(address)
+        values = []
+        while True:
+            dot = max(address.rfind('.', at + 1, pos), at)
+            node = node.children.get(address[dot + 1:pos])
+            if node is None:
+                break
+            if node.value is not None and (at >= 0 or dot == at):
+                values.append(node.value)
+            if dot == at:
+                if at >= 0 and address[:at] in node.users:
+                    values.append(node.users[address[:at]])
+                break
+            pos = dot
+        return values
+
+
 class eset(set):
     """A set class for e-mail addresses that checks membership based on domains."""
 
     def __contains__(self, item):
-        for p in parts_of(item):
-            if super(eset, self).__contains__(p):
-                return True
-        return False
+        index = getattr(self, '_eset__index', None)
+        if index is None:
+            index = self.__index = DomainIndex()
+            for address in self:
+                index[address] = True
+        return index.find(item)[0] is not None
+
+def _invalidating(name):
+    method = getattr(set, name)
+    def _inner(self, *args, **kwargs):
+        self._eset__index = None
+        return method(self, *args, **kwargs)
+    _inner.__name__ = name
+    return _inner
+
+for _name in ('add', 'discard', 'remove', 'pop', 'clear', 'update',
+              'difference_update', 'intersection_update', 'symmetric_difference_update',
+              '__ior__', '__iand__', '__isub__', '__ixor__'):
+    setattr(eset, _name, _invalidating(_name))
 
 
 class virtual_set(object):
@@ -79,7 +211,9 @@ class ACL(object):
     ROLE = Enum(['undefined', 'banned', 'user', 'admin', 'owner'])
 
     def __init__(self, caller, config = None):
-        self.__dict = defaultdict(str)
+        self.__dict = {}
+        self.__index = DomainIndex()
+        self.__counts = defaultdict(int)
         self._post_init()
 
 
@@ -92,17 +226,33 @@ class ACL(object):
 
 
     def __getitem__(self, jid):
-        return self.__dict[jid]
+        return self.__dict.get(jid, '')
 
     def __setitem__(self, jid, role):
+        if jid in self.__dict:
+            self.__counts[self.__dict[jid]] -= 1
         self.__dict[jid] = role
+        self.__index[jid] = role
+        self.__counts[role] += 1
 
     def __delitem__(self, jid):
-        del self.__dict[jid]
+        role = self.__dict.pop(jid)
+        del self.__index[jid]
+        self.__counts[role] -= 1
 
-    def __contains__(self, key):
+    def __contains__(self, jid):
         return jid in self.__dict
 
+    def __len__(self):
+        return len(self.__dict)
+
+    def clear(self):
+        """ Remove all jids.
+        """
+        self.__dict.clear()
+        self.__index.clear()
+        self.__counts.clear()
+
     def update_from_xml(self, xmlnode):
         """ Add the jids in an xmlnode.
         """
@@ -115,10 +265,7 @@ class ACL(object):
     def find_part(self, jid):
         """ For a given jid, find the part that is in the acl
         """
-        for p in parts_of(jid):
-            if p in self:
-                return p
-        return None
+        return self.__index.find(jid)[0]
 
 
     def check(self, jid, role):
@@ -129,10 +276,13 @@ class ACL(object):
 
         if not isinstance(role, collections.Iterable):
             role = (role, )
-        for p in parts_of(jid):
-            if self[p] in role:
-                return True
-        return False
+        return self.__index.find(jid, role)[0] is not None
+
+
+    def roles_of(self, jid):
+        """ Returns a frozenset with the roles of all parts of a jid in the acl
+        """
+        return frozenset(self.__index.find_all(jid))
 
 
     def count(self, role=None):
@@ -142,19 +292,23 @@ class ACL(object):
             return len(self)
 
         if isinstance(role, collections.Iterable):
-            return reduce(sum, [self.__dict.values().count(r) for r in role])
+            return sum([self.__counts[r] for r in role])
 
-        return self.__dict.values().count(role)
+        return self.__counts[role]
 
 
 class ACLdb(ACL):
-    """ Database storage for access control lists
+    """ Database storage for access control lists.
+        The acl is kept in memory: reads are answered from memory and writes
+        go to the database and then to memory.
     """
 
     def __init__(self, caller, config = None):
+        super(ACLdb, self).__init__(caller, config)
         self.store = caller.store
+        self.__lock = threading.RLock()
         self.create_table()
-        self._post_init()
+        self.refresh()
 
 
     def create_table(self):
@@ -165,61 +319,29 @@ class ACLdb(ACL):
                 logging.info("ACLdb: acl table created")
 
 
-    def __getitem__(self, jid):
-        with self.store.context_cursor() as cur:
-            cur.execute('SELECT role FROM acl WHERE jid = ?', (jid, ))
-            return cur.fetchone()[0]
+    def refresh(self):
+        """ Discard the in-memory acl and load it again from the database.
+        """
+        with self.__lock:
+            with self.store.context_cursor() as cur:
+                cur.execute('SELECT jid, role FROM acl')
+                rows = cur.fetchall()
+            self.clear()
+            for (jid, role) in rows:
+                super(ACLdb, self).__setitem__(jid, role)
+        logging.debug("ACLdb: %d jids loaded" % len(rows))
 
     def __setitem__(self, jid, role):
-        with self.store.context_cursor() as cur:
-            cur.execute('SELECT * FROM acl WHERE jid=?', (jid, ))
-            if (len(cur.fetchall()) > 0):
-                cur.execute('UPDATE acl SET jid=?, role=? WHERE jid=?', (jid, role, jid))
-            else:
-                cur.execute('INSERT INTO acl(jid, role) VALUES(?,?)', (jid, role))
+        with self.__lock:
+            with self.store.context_cursor() as cur:
+                cur.execute('INSERT INTO acl(jid, role) VALUES(?,?) ON CONFLICT(jid) DO UPDATE SET role=excluded.role', (jid, role))
+            super(ACLdb, self).__setitem__(jid, role)
 
     def __delitem__(self, jid):
-        with self.store.context_cursor() as cur:
-            cur.execute('DELETE FROM acl WHERE jid=?', (jid, ))
-
-    def __contains__(self, jid):
-        with self.store.context_cursor() as cur:
-            cur.execute('SELECT count(*) FROM acl WHERE jid = ?', (jid, ))
-            return int(cur.fetchone()[0]) > 0
-
-    def check(self, jid, role):
-        """ Check if jid is in a role/roles
-                jid  -- a string with the jid or domain to check
-                role -- an item of ROLE enum or collection of such items
-        """
-        jid = tuple(parts_of(jid))
-        if isinstance(role, collections.Iterable):
-            query = 'SELECT count(*) FROM acl WHERE jid IN (%s) and role IN (%s)' % (in_clause_subs(len(jid)), in_clause_subs(len(role)))
-            pars = jid + tuple(role)
-        else:
-            query = 'SELECT count(*) FROM acl WHERE jid IN (%s) and role = ?' % (in_clause_subs(len(jid)))
-            pars = jid + (role, )
-
-        with self.store.context_cursor() as cur:
-            cur.execute(query, pars)
-            return int(cur.fetchone()[0]) > 0
-
-
-    def count(self, role=None):
-        """ Returns the number of jids that are in role.
-        """
-        if role is None:
-            query = 'SELECT count(*) FROM acl'
-            role = ()
-        elif isinstance(role, collections.Iterable):
-            query = 'SELECT count(*) FROM acl WHERE role IN (%s)' % in_clause_subs(role)
-        else:
-            query = 'SELECT count(*) FROM acl WHERE role = ?'
-            role = (role, )
-
-        with self.store.context_cursor() as cur:
-            cur.execute(query, role)
-            return int(cur.fetchone()[0])
+        with self.__lock:
+            with self.store.context_cursor() as cur:
+                cur.execute('DELETE FROM acl WHERE jid=?', (jid, ))
+            super(ACLdb, self).__delitem__(jid)
 
 
 if __name__ == '__main__':
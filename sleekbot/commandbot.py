@@ -9,12 +9,26 @@ __license__ = 'MIT License/X11 license'
 from functools import wraps
 
 import collections
+from collections import namedtuple, deque
 import logging
 import inspect
 import threading
+import time
 import re
 
 from heapq import heappush
+from operator import itemgetter
+
+from scheduler import CommandScheduler, TaskLoop
+import metrics
+
+MESSAGES = metrics.registry.counter('sleekbot_messages_total', 'Messages received')
+COMMANDS = metrics.registry.counter('sleekbot_commands_total', 'Commands executed', ('command', ))
+COMMAND_ERRORS = metrics.registry.counter('sleekbot_command_errors_total', 'Commands that raised an exception', ('command', ))
+COMMAND_SECONDS = metrics.registry.histogram('sleekbot_command_seconds', 'Time spent executing commands', ('command', ))
+ACL_SECONDS = metrics.registry.histogram('sleekbot_acl_lookup_seconds', 'Time spent resolving the acl roles of a sender')
+
+RegexType = type(re.compile(''))
 
 def get_class(class_string):
     """ Returns class object specified by a string.
@@ -41,7 +55,8 @@ def denymsg(msg):
     return _outer
 
 
-def botcmd(name='', usage='', title='', doc='', IM=True, MUC=True, hidden=False, allow=True):
+def botcmd(name='', usage='', title='', doc='', IM=True, MUC=True, hidden=False, allow=True,
+           max_concurrency=None, timeout=None):
     """ Method decorator to declare a bot command
         The method signature has to be (self, cmd, args, msg):
             cmd  -- string with the command
@@ -62,6 +77,13 @@ def botcmd(name='', usage='', title='', doc='', IM=True, MUC=True, hidden=False,
             hidden -- command will not be displayed in the help (default False)
             allow  -- callable to check if the user has permissions to run the command
                         (default True)
+            max_concurrency -- maximum number of simultaneous executions
+                        (default None, no limit)
+            timeout -- seconds after which the user is told that the command
+                        timed out and its reply is discarded (default None)
+
+        Commands declaring max_concurrency or timeout run in the bot's
+        CommandScheduler. The others run in the thread handling the message.
     """
     def _outer(f):
         if allow is True: # Warning this is not the same as if allow:
@@ -89,6 +111,8 @@ def botcmd(name='', usage='', title='', doc='', IM=True, MUC=True, hidden=False,
         _inner._botcmd['IM'] = IM
         _inner._botcmd['MUC'] = MUC
         _inner._botcmd['allow'] = allow
+        _inner._botcmd['max_concurrency'] = max_concurrency
+        _inner._botcmd['timeout'] = timeout
         return _inner
     return _outer
 
@@ -115,13 +139,16 @@ class botfreetxt(object):
                 self.regex = re.compile(regex)
             except:
                 self.regex = None
-        elif not isinstance(regex, re.RegexObject):
+        elif not isinstance(regex, RegexType):
             self.regex = None
+        else:
+            self.regex = regex
 
     def __call__(self, f):
         def _inner(self_inner, text, msg, command_found, freetext_found, match=None):
             if self.regex:
-                match = self.regex.search(text)
+                if match is None:
+                    match = self.regex.search(text)
                 if match:
                     return f(self_inner, text, msg, command_found, freetext_found, match)
                 else:
@@ -138,6 +165,136 @@ class botfreetxt(object):
         return _inner
 
 
+class ParsedMsg(namedtuple('ParsedMsg', 'body prefix command args')):
+    """ The body of a message tokenized once.
+            body    -- the body that was parsed
+            prefix  -- command prefix for the type of message
+            command -- command name without prefix, or None if the body does
+                       not start with the prefix
+            args    -- stripped arguments (everything after the first word)
+    """
+    __slots__ = ()
+
+
+def parse_body(body, prefix):
+    """ Returns a ParsedMsg for a message body and a command prefix.
+    """
+    (head, _, args) = body.strip().partition(' ')
+    if head.startswith(prefix):
+        return ParsedMsg(body, prefix, head[len(prefix):], args.strip())
+    return ParsedMsg(body, prefix, None, args.strip())
+
+
+class FreetextMatcher(object):
+    """ Finds the free text parsers whose regex matches a text.
+        The regexes are combined in a single alternation that is searched
+        first: when it does not match, no parser with a regex can match and
+        none of them is searched. Regexes that cannot be safely combined
+        (compile flags, backreferences) are always searched.
+    """
+
+    def __init__(self, freetext):
+        """ freetext -- iterable of (priority, parser) tuples
+        """
+        self.parsers = [f for (p, f) in sorted(freetext, key = itemgetter(0))]
+        patterns = []
+        for f in self.parsers:
+            regex = f._botfreetxt['regex']
+            if regex is not None and self.combinable(regex):
+                patterns.append('(?:%s)' % regex.pattern)
+        self.combined = None
+        if patterns:
+            try:
+                self.combined = re.compile('|'.join(patterns))
+            except Exception, e:
+                # python 2 raises AssertionError beyond 100 groups
+                logging.warning("Cannot combine free text regexes, searching them one by one: %r" % e)
+
+    def combinable(self, regex):
+        return regex.flags == 0 and re.search(r'\\[1-9]|\(\?P=', regex.pattern) is None
+
+    def match(self, text):
+        """ Returns a list of (parser, match) in priority order for the parsers
+            that must be run on text. match is None for parsers without regex.
+        """
+        candidates = []
+        prefiltered = self.combined is not None and self.combined.search(text) is None
+        for f in self.parsers:
+            regex = f._botfreetxt['regex']
+            if regex is None:
+                candidates.append((f, None))
+            elif prefiltered and self.combinable(regex):
+                continue
+            else:
+                match = regex.search(text)
+                if match:
+                    candidates.append((f, match))
+        return candidates
+
+    def __len__(self):
+        return len(self.parsers)
+
+
+def timed_command(f):
+    """ Wraps a command to count its executions and errors and measure its latency.
+    """
+    labels = (f._botcmd['name'], )
+    @wraps(f)
+    def _inner(*args, **kwargs):
+        COMMANDS.inc(labels)
+        started = time.time()
+        try:
+            return f(*args, **kwargs)
+        except Exception:
+            COMMAND_ERRORS.inc(labels)
+            raise
+        finally:
+            COMMAND_SECONDS.observe(time.time() - started, labels)
+    return _inner
+
+
+class AuthContext(object):
+    """ Authorization data of a message: the real jid of the sender and its
+        roles in the acl. Both are computed lazily and at most once per message.
+        Use CommandBot.auth_context to get the context of a message.
+    """
+
+    def __init__(self, bot, msg):
+        self.__bot = bot
+        self.__msg = msg
+        self.__jid = None
+        self.__roles = None
+
+    @property
+    def jid(self):
+        """ Real (bare) jid of the sender or None if unknown.
+        """
+        if self.__jid is None:
+            self.__jid = (self.__bot.resolve_real_jid(self.__msg), )
+        return self.__jid[0]
+
+    @property
+    def roles(self):
+        """ frozenset with the acl roles of the sender.
+        """
+        if self.__roles is None:
+            jid = self.jid
+            acl = self.__bot.acl
+            with ACL_SECONDS.time():
+                if jid is None:
+                    self.__roles = frozenset()
+                elif hasattr(acl, 'roles_of'):
+                    self.__roles = acl.roles_of(jid)
+                else:
+                    self.__roles = frozenset([role for role in range(len(acl.ROLE)) if acl.check(jid, role)])
+        return self.__roles
+
+    def has_role(self, *roles):
+        """ True if the sender has any of the roles.
+        """
+        return not self.roles.isdisjoint(roles)
+
+
 class CommandBot(object):
     """ Base class for bots that accept commands.
         Requires to be coinherited with a class that has the following commands
@@ -163,6 +320,20 @@ class CommandBot(object):
                         <jid>banneduser@server.com</jid>
                     </banned>
                 </acl>
+                <scheduler workers='4' queue='100' wait='5' />
+                <pause queue='100' overflow='drop-oldest' />
+                <metrics enabled='true' dump='300' />
+
+        Messages received while paused wait in a queue of at most queue
+        messages. When it is full, overflow='drop-oldest' discards the oldest
+        message and overflow='reject' tells the sender to try again later.
+
+        Metrics (see metrics.Registry) are collected in self.metrics only if
+        enabled. dump is the interval in seconds at which they are logged
+        (default 0, never).
+
+        Plugins can use self.scheduler (CommandScheduler) to run blocking calls
+        and self.tasks (TaskLoop) for timed and periodic callbacks.
     """
 
     def __init__(self, im_prefix = '/', muc_prefix = '!' ):
@@ -182,7 +353,34 @@ class CommandBot(object):
             self.im_prefix = prefix.attrib.get('im', im_prefix)
             self.muc_prefix = prefix.attrib.get('muc', muc_prefix)
 
-        self.__event = threading.Event()
+        scheduler = self.botconfig.find('scheduler')
+        if scheduler is None:
+            self.scheduler = CommandScheduler()
+        else:
+            self.scheduler = CommandScheduler(int(scheduler.attrib.get('workers', 4)),
+                                              int(scheduler.attrib.get('queue', 100)),
+                                              float(scheduler.attrib.get('wait', 5)))
+        self.tasks = TaskLoop(self.scheduler)
+        self.real_jids = {}
+
+        options = self.botconfig.find('metrics')
+        options = {} if options is None else options.attrib
+        self.metrics = metrics.registry
+        self.metrics.enabled = options.get('enabled', 'false').lower() == 'true'
+        dump = float(options.get('dump', 0))
+        if self.metrics.enabled and dump > 0:
+            self.tasks.call_every(dump, self.dump_metrics)
+
+        pause = self.botconfig.find('pause')
+        pause = {} if pause is None else pause.attrib
+        self.pause_queue_size = int(pause.get('queue', 100))
+        self.pause_overflow = pause.get('overflow', 'drop-oldest')
+        if self.pause_overflow not in ('drop-oldest', 'reject'):
+            raise ValueError("Unknown pause overflow policy %s" % self.pause_overflow)
+        self.__paused = True
+        self.__draining = False
+        self.__queue = deque()
+        self.__queue_lock = threading.Lock()
         CommandBot.start(self)
 
     def register_commands(self, obj):
@@ -197,6 +395,8 @@ class CommandBot(object):
                     self.muc_commands[f._botcmd['name']] = f
             elif inspect.ismethod(f) and hasattr(f, '_botfreetxt'):
                 heappush(self.freetext, (f._botfreetxt['priority'], f))
+        self.freetext_matcher = FreetextMatcher(self.freetext)
+        self.help_cache = {}
 
     def unregister_commands(self, obj):
         """ Unregister bot methods from an object
@@ -210,6 +410,8 @@ class CommandBot(object):
                     del self.muc_commands[f._botcmd['name']]
             elif inspect.ismethod(f) and hasattr(f, '_botfreetxt'):
                 self.freetext.remove((f._botfreetxt['priority'], f))
+        self.freetext_matcher = FreetextMatcher(self.freetext)
+        self.help_cache = {}
 
     def start(self):
         """ Mesages will be received and processed
@@ -217,6 +419,7 @@ class CommandBot(object):
         logging.info("Starting CommandBot")
         CommandBot.reset(self)
         self.add_event_handler("message", self.handle_msg_botcmd, threaded=True)
+        self.add_event_handler("groupchat_presence", self.handle_real_jid_presence)
         CommandBot.resume(self)
 
     def reset(self):
@@ -227,10 +430,16 @@ class CommandBot(object):
 
         self.freetext = []
         self.register_commands(self)
+        self._default_msg_event = self.handle_msg_event.im_func is CommandBot.handle_msg_event.im_func
+        self.reset_acl()
 
+    def reset_acl(self):
+        """ Reload the acl and membership requirement from botconfig
+        """
         aclnode = self.botconfig.find('acl')
         self.acl = get_class(aclnode.attrib.get('classname', 'acl.ACL'))(self, aclnode.attrib.get('config', ''))
         self.acl.update_from_xml(aclnode)
+        self.help_cache = {}
         self.require_membership = self.botconfig.find('require-membership') != None
         logging.info('%d owners, %d admins, %d users, %d banned. Require-membership %s' % \
                     ( len(self.acl.owners), len(self.acl.admins), len(self.acl.users), len(self.acl.banned), self.require_membership))
@@ -240,17 +449,68 @@ class CommandBot(object):
         """
         logging.info("Stopping CommandBot")
         self.del_event_handler("message", self.handle_msg_botcmd)
+        self.del_event_handler("groupchat_presence", self.handle_real_jid_presence)
+        self.real_jids = {}
+        with self.__queue_lock:
+            self.__paused = True
+            if self.__queue:
+                logging.warning("CommandBot: %d queued messages discarded" % len(self.__queue))
+            self.__queue.clear()
+        self.tasks.stop()
+        self.scheduler.stop()
 
 
     def pause(self):
         """ Received messages will be enqueued for processing
         """
-        self.__event.clear()
+        with self.__queue_lock:
+            self.__paused = True
 
     def resume(self):
-        """ Received messages will be processed
+        """ Received messages will be processed. The messages enqueued while
+            paused are processed first, in order, by a single thread.
         """
-        self.__event.set()
+        with self.__queue_lock:
+            self.__paused = False
+            if not self.__queue or self.__draining:
+                return
+            self.__draining = True
+            logging.info("CommandBot: replaying %d queued messages" % len(self.__queue))
+        thread = threading.Thread(target = self.__drain, name = 'CommandBot-replay')
+        thread.daemon = True
+        thread.start()
+
+    def __drain(self):
+        """ Process the enqueued messages until the queue is empty or the bot
+            is paused again.
+        """
+        while True:
+            with self.__queue_lock:
+                if self.__paused or not self.__queue:
+                    self.__draining = False
+                    return
+                msg = self.__queue.popleft()
+            try:
+                self.dispatch_msg(msg)
+            except Exception:
+                logging.exception("CommandBot: error while replaying a message")
+
+    def __enqueue(self, msg):
+        """ Enqueue a message received while paused. Returns False if it has
+            to be rejected. Requires __queue_lock.
+        """
+        if len(self.__queue) >= self.pause_queue_size:
+            if self.pause_overflow == 'reject':
+                return False
+            self.__queue.popleft()
+            logging.warning("CommandBot: pause queue full, oldest message dropped")
+        self.__queue.append(msg)
+        return True
+
+    def dump_metrics(self):
+        """ Log a summary of the metrics.
+        """
+        logging.info("Metrics:\n%s" % self.metrics.summary())
 
     def handle_msg_event(self, msg, command_found = False, freetext_found = False):
         """ Performs extra actions on the message.
@@ -259,48 +519,116 @@ class CommandBot(object):
         pass
 
     def handle_msg_botcmd(self, msg):
-        """ Message handler. Execution order:
-                0.- check should_answer_msg
-                1.- Execute matching command (if any)
-                2.- Forward msg to red free text parsers
-                3.- Forward msg to handle_msg_event
-
+        """ Message handler. Enqueues the message while the bot is paused
+            (or replaying the queue) and otherwise dispatches it.
                 msg -- dictionary containing message properties (see SleekXMPP)
         """
+        MESSAGES.inc()
+        with self.__queue_lock:
+            queued = self.__paused or self.__draining
+            if queued:
+                accepted = self.__enqueue(msg)
+        if not queued:
+            self.dispatch_msg(msg)
+        elif not accepted and self.parse_msg(msg).command is not None:
+            self.reply(msg, 'Sorry, I am too busy right now. Try again later.')
+
+    def dispatch_msg(self, msg):
+        """ Process a message. Execution order:
+                0.- tokenize the body (see parse_msg), find the matching free
+                    text parsers (see FreetextMatcher) and return early if no
+                    command, free text parser or handle_msg_event can use it
+                1.- check should_answer_msg
+                2.- Execute matching command (if any)
+                3.- Forward msg to red free text parsers
+                4.- Forward msg to handle_msg_event
+            Plugins routing a rewritten message again (see alias) call this
+            method, which skips the pause queue and the message counter.
 
-        self.__event.wait()
+                msg -- dictionary containing message properties (see SleekXMPP)
+        """
+        parsed = self.parse_msg(msg)
+        self.auth_context(msg)
+        if parsed.command is None:
+            f = None
+        elif msg['type'] == 'groupchat':
+            f = self.muc_commands.get(parsed.command)
+        else:
+            f = self.im_commands.get(parsed.command)
+        candidates = self.freetext_matcher.match(parsed.body)
+        if f is None and not candidates and self._default_msg_event:
+            return
 
         if not self.should_answer_msg(msg):
             return
         command_found = False
-        if msg['type'] == 'groupchat':
-            prefix = self.muc_prefix
-            commands = self.muc_commands
-        else:
-            prefix = self.im_prefix
-            commands = self.im_commands
-        command = msg.get('body', '').strip().split(' ', 1)[0]
-        if ' ' in msg.get('body', ''):
-            args = msg['body'].split(' ', 1)[-1].strip()
-        else:
-            args = ''
-        if command.startswith(prefix):
-            if len(prefix):
-                command = command.split(prefix, 1)[-1]
-            if command in commands:
-                command_found = True
-                response = commands[command](command, args, msg)
-                self.reply(msg, response)
+        if f is not None:
+            command_found = True
+            self.run_command(f, parsed, msg)
 
         freetext_found = False
-        for (p, f) in self.freetext:
-            response = f(msg['body'], msg, command_found, freetext_found)
+        for (f, match) in candidates:
+            response = f(parsed.body, msg, command_found, freetext_found, match)
             if not response is None:
                 freetext_found = True
                 self.reply(msg, response)
 
         self.handle_msg_event(msg, command_found, freetext_found)
 
+    def run_command(self, f, parsed, msg):
+        """ Execute a command and reply with its response.
+            Commands declaring max_concurrency or timeout are handed to the
+            scheduler, the rest are executed right away.
+        """
+        max_concurrency = f._botcmd['max_concurrency']
+        timeout = f._botcmd['timeout']
+        if self.metrics.enabled:
+            f = timed_command(f)
+        if max_concurrency is None and timeout is None:
+            self.reply(msg, f(parsed.command, parsed.args, msg))
+            return
+
+        def on_done(response):
+            self.reply(msg, response)
+
+        def on_timeout():
+            self.reply(msg, 'Sorry, %s is taking too long.' % parsed.command)
+
+        if not self.scheduler.submit(f._botcmd['name'], f, (parsed.command, parsed.args, msg), on_done,
+                                     max_concurrency, timeout, on_timeout):
+            self.reply(msg, 'Sorry, I am too busy right now. Try again later.')
+
+    def auth_context(self, msg):
+        """ Returns the AuthContext of a message. It is created once and kept
+            in the message, so the real jid and acl roles are resolved at most
+            once per message.
+        """
+        auth = getattr(msg, 'auth', None)
+        if auth is None:
+            auth = AuthContext(self, msg)
+            try:
+                msg.auth = auth
+            except AttributeError:
+                pass
+        return auth
+
+    def parse_msg(self, msg):
+        """ Returns the ParsedMsg of a message. The body is tokenized only once
+            and the result is kept in the message while the body is unchanged.
+        """
+        body = msg.get('body', '')
+        parsed = getattr(msg, 'parsed', None)
+        if parsed is None or parsed.body != body:
+            if msg['type'] == 'groupchat':
+                parsed = parse_body(body, self.muc_prefix)
+            else:
+                parsed = parse_body(body, self.im_prefix)
+            try:
+                msg.parsed = parsed
+            except AttributeError:
+                pass
+        return parsed
+
     def reply(self, msg, response):
         """ Reply to a message. This will not be needed when msg.reply works for all cases in SleekXMPP
         """
@@ -334,66 +662,123 @@ class CommandBot(object):
             else:
                 response += '%s is not a valid command' % args
 
-        response += "Commands:\n"
-        for command in sorted(commands.keys()):
-            f = commands[command]
-            if not f._botcmd['hidden'] and (f._botcmd['allow'] is True or f._botcmd['allow'](self, msg)):
-                response += "%s -- %s\n" % (command,  f._botcmd['title'])
-        response += "---------\n"
-        return response
+        return response + self.help_listing(msg)
+
+    def help_listing(self, msg):
+        """ Returns the list of commands available to the sender of msg.
+            The listing is cached per message type and acl roles of the sender.
+            Commands whose allow is not one of msg_from_owner/admin/member
+            depend on more than the roles and are checked on every call.
+        """
+        groupchat = msg['type'] == 'groupchat'
+        key = (groupchat, self.auth_context(msg).roles)
+        listing = self.help_cache.get(key)
+        if listing is None:
+            commands = self.muc_commands if groupchat else self.im_commands
+            role_checks = (CommandBot.msg_from_owner.im_func, CommandBot.msg_from_admin.im_func,
+                           CommandBot.msg_from_member.im_func)
+            listing = []
+            for command in sorted(commands.keys()):
+                f = commands[command]
+                if f._botcmd['hidden']:
+                    continue
+                allow = f._botcmd['allow']
+                line = "%s -- %s\n" % (command,  f._botcmd['title'])
+                if allow is True or getattr(allow, 'im_func', allow) in role_checks:
+                    if allow is True or allow(self, msg):
+                        listing.append((line, None))
+                else:
+                    listing.append((line, allow))
+            if all([allow is None for (line, allow) in listing]):
+                listing = ''.join([line for (line, allow) in listing])
+            self.help_cache[key] = listing
+        if not isinstance(listing, basestring):
+            listing = ''.join([line for (line, allow) in listing if allow is None or allow(self, msg)])
+        return "Commands:\n%s---------\n" % listing
 
     @denymsg('You are not my owner')
     def msg_from_owner(self, msg):
         """ Was this message sent from a bot owner?
         """
-        jid = self.get_real_jid(msg)
-        return jid in self.acl.owners
+        return self.auth_context(msg).has_role(self.acl.ROLE.owner)
 
     @denymsg('You are not my admin')
     def msg_from_admin(self, msg):
         """ Was this message sent from a bot admin?
         """
-        jid = self.get_real_jid(msg)
-        return jid in self.acl.owners or jid in self.acl.admins
+        return self.auth_context(msg).has_role(self.acl.ROLE.owner, self.acl.ROLE.admin)
 
     @denymsg('You are not a member')
     def msg_from_member(self, msg):
         """ Was this message sent from a bot member?
         """
-        jid = self.get_real_jid(msg)
-        return jid in self.acl.owners or jid in self.acl.admins or jid in self.acl.users
+        return self.auth_context(msg).has_role(self.acl.ROLE.owner, self.acl.ROLE.admin, self.acl.ROLE.user)
+
+    def handle_real_jid_presence(self, presence):
+        """ Keep the real_jids cache (room -> nick -> real jid) up to date.
+            Nick changes arrive as an unavailable presence for the old nick
+            followed by an available one for the new nick.
+        """
+        room = presence['from'].bare
+        nick = presence['from'].resource
+        if presence['type'] == 'unavailable':
+            if nick == self.plugin['xep_0045'].ourNicks.get(room):
+                self.forget_room(room)
+            else:
+                self.real_jids.get(room, {}).pop(nick, None)
+        else:
+            real_jid = presence['muc']['jid']
+            if real_jid and real_jid.bare:
+                self.real_jids.setdefault(room, {})[nick] = real_jid
+            else:
+                self.real_jids.get(room, {}).pop(nick, None)
+
+    def forget_room(self, mucroom):
+        """ Drop the cached real jids of a room.
+        """
+        self.real_jids.pop(mucroom, None)
 
     def mucnick_to_jid(self, mucroom, mucnick):
         """ Returns the jid associated with a mucnick and mucroom
         """
+        try:
+            return self.real_jids[mucroom][mucnick]
+        except KeyError:
+            pass
         if mucroom in self.plugin['xep_0045'].getJoinedRooms():
             logging.debug("Checking real jid for %s %s" %(mucroom, mucnick))
             real_jid = self.plugin['xep_0045'].getJidProperty(mucroom, mucnick, 'jid')
             logging.debug(real_jid)
             if real_jid:
+                self.real_jids.setdefault(mucroom, {})[mucnick] = real_jid
                 return real_jid
             else:
                 return None
         return None
 
     def get_real_jid(self, msg):
-        """ Returns the real jid of a msg
+        """ Returns the real jid of a msg (resolved once per message, see auth_context)
+        """
+        return self.auth_context(msg).jid
+
+    def resolve_real_jid(self, msg):
+        """ Looks up the real jid of a msg. Returns None if it is not known.
         """
         if msg['type'] == 'groupchat' and msg['mucnick'] != msg['mucroom']:
-            return self.mucnick_to_jid(msg['mucroom'], msg['mucnick']).bare
+            real_jid = self.mucnick_to_jid(msg['mucroom'], msg['mucnick'])
+        elif msg['jid'] in self['xep_0045'].getJoinedRooms():
+            real_jid = self.mucnick_to_jid(msg['mucroom'], msg['mucnick'])
         else:
-            if msg['jid'] in self['xep_0045'].getJoinedRooms():
-                return self.mucnick_to_jid(msg['mucroom'], msg['mucnick']).bare
-            else:
-                return msg['from'].bare
-        return None
+            return msg['from'].bare
+        if real_jid is None:
+            return None
+        return real_jid.bare
 
     def should_answer_msg(self, msg):
         """ Checks whether the bot is configured to respond to the sender of a message.
             Overload if needed
         """
-        jid = self.get_real_jid(msg)
-        if jid in self.acl.banned:
+        if self.auth_context(msg).has_role(self.acl.ROLE.banned):
             return False
         if not self.require_membership:
             return True
@@ -0,0 +1,243 @@
+"""
+    This file is part of SleekBot. http://github.com/hgrecco/SleekBot
+    See the README file for more information.
+"""
+
+__author__ = 'Hernan E. Grecco <hernan.grecco@gmail.com>'
+__license__ = 'MIT License/X11 license'
+
+import logging
+import threading
+import time
+
+from bisect import bisect_left
+
+#: Default upper bounds (seconds) of histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, float('inf'))
+
+
+class Metric(object):
+    """ Base class of metrics. Values are kept per tuple of label values.
+        Updates are ignored while the registry is disabled.
+    """
+
+    kind = None
+
+    def __init__(self, registry, name, doc = '', labels = ()):
+        self.registry = registry
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def samples(self):
+        """ Returns a list of (label values, value).
+        """
+        with self.lock:
+            return sorted(self.values.items())
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    """ A value that only goes up (number of messages, errors, ...).
+    """
+
+    kind = 'counter'
+
+    def inc(self, labels = (), amount = 1):
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """ A value that goes up and down (queue depth, ...). It can be set or
+        read from a function when collected.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super(Gauge, self).__init__(*args, **kwargs)
+        self.function = None
+
+    def set(self, value, labels = ()):
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, labels = (), amount = 1):
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, labels = (), amount = 1):
+        self.inc(labels, -amount)
+
+    def set_function(self, function):
+        """ Read the value from function() (or a dict label values: value)
+            when collected.
+        """
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                logging.exception("metrics: error reading %s" % self.name)
+                value = None
+            if isinstance(value, dict):
+                return sorted(value.items())
+            elif value is not None:
+                return [((), value)]
+        return super(Gauge, self).samples()
+
+
+class Histogram(Metric):
+    """ Distribution of observed values (latencies). Keeps the count per
+        bucket, the sum and the count of the observations.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, doc = '', labels = (), buckets = BUCKETS):
+        super(Histogram, self).__init__(registry, name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels = ()):
+        if not self.registry.enabled:
+            return
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            data = self.values.get(labels)
+            if data is None:
+                data = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                data[0][index] += 1
+            data[1] += value
+            data[2] += 1
+
+    def time(self, labels = ()):
+        """ Returns a context manager observing the time spent in the block.
+        """
+        if not self.registry.enabled:
+            return _NOT_TIMED
+        return _Timer(self, labels)
+
+    def samples(self):
+        """ Returns a list of (label values, (cumulative bucket counts, sum, count)).
+        """
+        with self.lock:
+            samples = []
+            for (labels, (counts, total, count)) in sorted(self.values.items()):
+                cumulative = []
+                acc = 0
+                for n in counts:
+                    acc += n
+                    cumulative.append(acc)
+                samples.append((labels, (cumulative, total, count)))
+            return samples
+
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.histogram.observe(time.time() - self.started, self.labels)
+
+
+class _NotTimed(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        pass
+
+_NOT_TIMED = _NotTimed()
+
+
+class Registry(object):
+    """ Holds the metrics of the bot by name.
+        Metrics are created once (usually at import time) and updated in the
+        hot paths. While the registry is disabled an update is a single
+        attribute check.
+    """
+
+    def __init__(self, enabled = False):
+        self.enabled = enabled
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    def __get(self, aclass, name, *args, **kwargs):
+        with self.__lock:
+            metric = self.__metrics.get(name)
+            if metric is None:
+                metric = self.__metrics[name] = aclass(self, name, *args, **kwargs)
+            elif not isinstance(metric, aclass):
+                raise ValueError("Metric %s is already registered as a %s" % (name, metric.kind))
+            return metric
+
+    def counter(self, name, doc = '', labels = ()):
+        """ Returns the Counter name, creating it if needed.
+        """
+        return self.__get(Counter, name, doc, labels)
+
+    def gauge(self, name, doc = '', labels = ()):
+        """ Returns the Gauge name, creating it if needed.
+        """
+        return self.__get(Gauge, name, doc, labels)
+
+    def histogram(self, name, doc = '', labels = (), buckets = BUCKETS):
+        """ Returns the Histogram name, creating it if needed.
+        """
+        return self.__get(Histogram, name, doc, labels, buckets)
+
+    def metrics(self):
+        """ Returns the registered metrics sorted by name.
+        """
+        with self.__lock:
+            return [self.__metrics[name] for name in sorted(self.__metrics)]
+
+    def clear(self):
+        """ Reset the values of all metrics.
+        """
+        for metric in self.metrics():
+            metric.clear()
+
+    def summary(self, prefix = ''):
+        """ Returns a human readable summary of the metrics whose name starts
+            with prefix, one line per label values.
+        """
+        lines = []
+        for metric in self.metrics():
+            if not metric.name.startswith(prefix):
+                continue
+            for (labels, value) in metric.samples():
+                name = metric.name
+                if labels:
+                    name += '{%s}' % ','.join(['%s=%s' % item for item in zip(metric.labels, labels)])
+                if metric.kind == 'histogram':
+                    (cumulative, total, count) = value
+                    lines.append('%s: count %d, mean %.4f, total %.3f' % (name, count, total / (count or 1), total))
+                else:
+                    lines.append('%s: %s' % (name, value))
+        return '\n'.join(lines)
+
+#: Registry used by the bot
+registry = Registry()
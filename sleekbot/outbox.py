@@ -0,0 +1,251 @@
+"""
+    This file is part of SleekBot. http://github.com/hgrecco/SleekBot
+    See the README file for more information.
+"""
+
+__author__ = 'Hernan E. Grecco <hernan.grecco@gmail.com>'
+__license__ = 'MIT License/X11 license'
+
+import logging
+import threading
+import time
+
+from collections import deque
+
+import metrics
+
+SENT = metrics.registry.counter('sleekbot_outbox_sent_total', 'Stanzas sent', ('type', ))
+COALESCED = metrics.registry.counter('sleekbot_outbox_coalesced_total', 'Messages joined to a previous one')
+SPLIT = metrics.registry.counter('sleekbot_outbox_split_total', 'Extra stanzas created splitting long messages')
+DROPPED = metrics.registry.counter('sleekbot_outbox_dropped_total', 'Messages dropped because the queue was full')
+DEPTH = metrics.registry.gauge('sleekbot_outbox_depth', 'Messages waiting to be sent')
+SEND_SECONDS = metrics.registry.histogram('sleekbot_outbox_send_seconds', 'Time spent sending stanzas')
+
+class TokenBucket(object):
+    """ Allows rate messages per second with bursts of up to burst messages.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def available_at(self, now):
+        """ Returns the time at which a message can be sent.
+        """
+        self.refill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+class Outgoing(object):
+    """ A message waiting in the Outbox.
+    """
+
+    __slots__ = ('mto', 'mbody', 'mtype', 'kwargs', 'stamp', 'short')
+
+    def __init__(self, mto, mbody, mtype, kwargs, short):
+        self.mto = mto
+        self.mbody = mbody
+        self.mtype = mtype
+        self.kwargs = kwargs
+        self.stamp = time.time()
+        self.short = short
+
+
+def destination(mto):
+    """ Returns the key of the queue of mto (a jid or a string). Jids may
+        not be ascii, so they are never converted with str.
+    """
+    if isinstance(mto, basestring):
+        return mto
+    return unicode(mto)
+
+
+def split_body(body, max_length):
+    """ Splits a message body in parts of at most max_length characters,
+        breaking at line ends when possible.
+    """
+    parts = []
+    current = ''
+    for line in body.splitlines(True):
+        while len(line) > max_length:
+            if current:
+                parts.append(current)
+                current = ''
+            parts.append(line[:max_length])
+            line = line[max_length:]
+        if len(current) + len(line) > max_length:
+            parts.append(current)
+            current = ''
+        current += line
+    if current:
+        parts.append(current)
+    return [part.rstrip('\n') for part in parts]
+
+
+class Outbox(object):
+    """ Per destination queues of outgoing messages.
+        Each destination has its own token bucket so a burst of messages to
+        a room (RSS items, long help listings) is spread instead of tripping
+        the server rate limits. Short groupchat messages to the same room sent
+        within window seconds are coalesced in a single stanza and bodies
+        longer than max_length are split in several stanzas.
+        Messages are sent by a single thread.
+    """
+
+    def __init__(self, send, rate = 2.0, burst = 5, window = 0.2, max_length = 3000,
+                 short_length = 400, queue_size = 100):
+        """ Initialize the outbox and start the sending thread
+                send         -- callable with the signature of sendMessage
+                rate         -- messages per second to each destination (default 2)
+                burst        -- messages that can be sent at once to a destination (default 5)
+                window       -- seconds a short groupchat message waits for others
+                                to be coalesced with (default 0.2)
+                max_length   -- maximum characters of a message body (default 3000)
+                short_length -- maximum characters of a message to be coalesced (default 400)
+                queue_size   -- maximum messages waiting per destination. The oldest
+                                one is dropped when it is full (default 100)
+        """
+        self.__send = send
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self.max_length = max_length
+        self.short_length = short_length
+        self.queue_size = queue_size
+        self.__queues = {}
+        self.__buckets = {}
+        self.__cond = threading.Condition(threading.Lock())
+        self.__stopped = False
+        DEPTH.set_function(self.depth)
+        self.__thread = threading.Thread(target = self.__loop, name = 'Outbox')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def put(self, mto, mbody, mtype = None, **kwargs):
+        """ Enqueue a message. Keyword arguments as in sendMessage.
+        """
+        if self.__stopped:
+            self.__send(mto, mbody, mtype = mtype, **kwargs)
+            return
+        if isinstance(mbody, basestring) and len(mbody) > self.max_length:
+            bodies = split_body(mbody, self.max_length)
+            SPLIT.inc(amount = len(bodies) - 1)
+        else:
+            bodies = [mbody]
+        dest = destination(mto)
+        with self.__cond:
+            queue = self.__queues.setdefault(dest, deque())
+            for body in bodies:
+                short = mtype == 'groupchat' and not kwargs and isinstance(body, basestring) \
+                        and len(body) <= self.short_length
+                if len(queue) >= self.queue_size:
+                    queue.popleft()
+                    DROPPED.inc()
+                    logging.warning("Outbox: queue to %s full, oldest message dropped" % dest)
+                queue.append(Outgoing(mto, body, mtype, kwargs, short))
+            self.__cond.notify()
+
+    def depth(self, mto = None):
+        """ Returns the number of messages waiting to be sent to mto
+            (default to any destination).
+        """
+        with self.__cond:
+            if mto is None:
+                return sum([len(queue) for queue in self.__queues.values()])
+            return len(self.__queues.get(destination(mto), ()))
+
+    def depths(self):
+        """ Returns a dict destination: number of messages waiting.
+        """
+        with self.__cond:
+            return dict([(dest, len(queue)) for (dest, queue) in self.__queues.items()])
+
+    def stop(self, timeout = 5.0):
+        """ Send the waiting messages, without rate limits, and stop the thread.
+                timeout -- seconds to wait for the thread (default 5)
+        """
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify()
+        self.__thread.join(timeout)
+
+    def __ready_at(self, dest, queue, now):
+        bucket = self.__buckets.get(dest)
+        at = bucket.available_at(now) if bucket else now
+        if queue[0].short:
+            at = max(at, queue[0].stamp + self.window)
+        return at
+
+    def __pop(self, dest):
+        """ Remove the next message to dest, coalescing consecutive short ones.
+        """
+        queue = self.__queues[dest]
+        first = queue.popleft()
+        if first.short:
+            bodies = [first.mbody]
+            length = len(first.mbody)
+            while queue and queue[0].short and queue[0].mtype == first.mtype \
+                  and length + len(queue[0].mbody) + 1 <= self.max_length:
+                length += len(queue[0].mbody) + 1
+                bodies.append(queue.popleft().mbody)
+            if len(bodies) > 1:
+                first.mbody = '\n'.join(bodies)
+                COALESCED.inc(amount = len(bodies) - 1)
+        if not queue:
+            del self.__queues[dest]
+        return first
+
+    def __next(self):
+        """ Wait for the next message that can be sent. Returns None when stopped
+            and there is nothing left.
+        """
+        with self.__cond:
+            while True:
+                if self.__stopped:
+                    if not self.__queues:
+                        return None
+                    return self.__pop(self.__queues.keys()[0])
+                now = time.time()
+                wait = None
+                for (dest, queue) in self.__queues.items():
+                    at = self.__ready_at(dest, queue, now)
+                    if at <= now:
+                        bucket = self.__buckets.get(dest)
+                        if bucket is None:
+                            bucket = self.__buckets[dest] = TokenBucket(self.rate, self.burst)
+                        bucket.take(now)
+                        return self.__pop(dest)
+                    if wait is None or at - now < wait:
+                        wait = at - now
+                for dest in [dest for (dest, bucket) in self.__buckets.items()
+                             if dest not in self.__queues and bucket.full(now)]:
+                    del self.__buckets[dest]
+                self.__cond.wait(wait)
+
+    def __loop(self):
+        while True:
+            message = self.__next()
+            if message is None:
+                return
+            try:
+                SENT.inc((message.mtype or 'normal', ))
+                with SEND_SECONDS.time():
+                    self.__send(message.mto, message.mbody, mtype = message.mtype, **message.kwargs)
+            except Exception:
+                logging.exception("Outbox: error while sending a message to %s" % message.mto)
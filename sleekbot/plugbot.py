@@ -6,15 +6,24 @@
 __author__ = 'Hernan E. Grecco <hernan.grecco@gmail.com>'
 __license__ = 'MIT License/X11 license'
 
+import ast
+import hashlib
 import logging
+import os
+import threading
 
 from optparse import OptionParser
 from xml.etree import ElementTree as ET
 
 from pluginbase import PluginDict,  Plugin
+from commandbot import CommandBot, botcmd, denymsg
+
+# botcmd arguments in positional order
+BOTCMD_ARGS = ('name', 'usage', 'title', 'doc', 'IM', 'MUC', 'hidden', 'allow', 'max_concurrency', 'timeout')
 
 class BotPlugin(Plugin):
-    """ Base class for plugins used with CommandBot
+    """ Base class for plugins used with CommandBot.
+        Its commands are registered once on_register finished.
     """
     def _set_dict(self, value):
         if value is None:
@@ -22,22 +31,135 @@ class BotPlugin(Plugin):
         else:
             self.bot = value.bot
             super(BotPlugin,  self)._set_dict(value)
-            self.bot.register_commands(self)
+
+    def _registered(self):
+        self.bot.register_commands(self)
 
     plugin_dict = property(fget = Plugin._get_dict, fset = _set_dict)
 
+
+class LazyBotPlugin(BotPlugin):
+    """ Placeholder registering the commands of a plugin that has not been
+        imported yet. The first command invoked activates the real plugin
+        (see PluginDict.activate) and is then executed by it.
+        Use lazy_plugin_class to build the placeholder class of a plugin.
+    """
+
+    def __init__(self, config, lazy):
+        super(LazyBotPlugin, self).__init__(config)
+        self.lazy = lazy
+        self.__lock = threading.Lock()
+        self.__plugin = None
+
+    def activate(self):
+        """ Returns the real plugin, activating it if needed.
+        """
+        with self.__lock:
+            if self.__plugin is None:
+                self.__plugin = self.plugin_dict.activate(self.__class__.__name__)
+            if self.__plugin is None:
+                raise RuntimeError("Plugin %s could not be activated" % self.__class__.__name__)
+            return self.__plugin
+
+
+def _lazy_command(method):
+    """ Returns a method that activates the plugin and runs its method.
+    """
+    def _inner(self, command, args, msg):
+        return getattr(self.activate(), method)(command, args, msg)
+    _inner.__name__ = method
+    return _inner
+
+def _literal(node):
+    """ Returns the value of a botcmd argument found in the source.
+        The allow argument can be a CommandBot.msg_from_* method.
+        Raises ValueError if the value can not be known without importing.
+    """
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) \
+       and node.value.id == 'CommandBot' and node.attr.startswith('msg_from_'):
+        return getattr(CommandBot, node.attr)
+    return ast.literal_eval(node)
+
+def scan_commands(path, name):
+    """ Reads the commands of a plugin class from its source without importing it.
+            path -- python file declaring the plugin
+            name -- name of the plugin class
+
+        Returns a list of (method name, botcmd arguments dict, docstring, denymsg).
+        Raises ValueError if the commands can not be known from the source or
+        the plugin has to be loaded at start: it derives from other classes
+        than BotPlugin (inherited commands) or defines on_register (it may
+        hook events).
+    """
+    tree = ast.parse(open(path).read(), path)
+    classes = [node for node in tree.body if isinstance(node, ast.ClassDef) and node.name == name]
+    if not classes:
+        raise ValueError("class %s not found in %s" % (name, path))
+    bases = [getattr(base, 'id', getattr(base, 'attr', None)) for base in classes[0].bases]
+    if bases != ['BotPlugin']:
+        raise ValueError("%s derives from %s" % (name, ', '.join([str(base) for base in bases])))
+    commands = []
+    for node in classes[0].body:
+        if not isinstance(node, ast.FunctionDef):
+            continue
+        if node.name == 'on_register':
+            raise ValueError("%s defines on_register" % name)
+        kwargs = None
+        deny = None
+        for decorator in node.decorator_list:
+            call = decorator if isinstance(decorator, ast.Call) else None
+            func = call.func if call else decorator
+            fname = getattr(func, 'id', getattr(func, 'attr', None))
+            if fname == 'botfreetxt':
+                raise ValueError("%s.%s handles free text" % (name, node.name))
+            elif fname == 'botcmd':
+                kwargs = {}
+                if call:
+                    if call.starargs or call.kwargs:
+                        raise ValueError("%s.%s: variable botcmd arguments" % (name, node.name))
+                    for (arg, value) in zip(BOTCMD_ARGS, call.args):
+                        kwargs[arg] = _literal(value)
+                    for keyword in call.keywords:
+                        kwargs[keyword.arg] = _literal(keyword.value)
+            elif fname == 'denymsg':
+                deny = ast.literal_eval(call.args[0])
+        if kwargs is not None:
+            commands.append((node.name, kwargs, ast.get_docstring(node, False), deny))
+    return commands
+
+def lazy_plugin_class(name, commands):
+    """ Builds a LazyBotPlugin subclass named as the plugin with a command
+        for each command of the plugin (see scan_commands).
+    """
+    attrs = {}
+    for (method, kwargs, doc, deny) in commands:
+        f = _lazy_command(method)
+        f.__doc__ = doc
+        if deny is not None:
+            f = denymsg(deny)(f)
+        attrs[method] = botcmd(**kwargs)(f)
+    return type(name, (LazyBotPlugin, ), attrs)
+
 class PlugBot(object):
     """ Base class for bots that are pluggable
         Requires to be coinherited with a class that has a property named
             botconfig -- XML ElementTree from the config file. For example:
-                <bot>
+                <bot workers='4' timeout='30'>
                     <plugin name='plugin1'>
                         <config />
                     </plugin>
                     <plugin name='plugin2' package='anotherpackage'>
                         <config />
                     </plugin>
+                    <plugin name='plugin3' lazy='true'>
+                        <config />
+                    </plugin>
                 <bot>
+        A lazy plugin is not imported until one of its commands is used.
+        Its commands are read from the source of the plugin. Plugins handling
+        free text, whose botcmd arguments are not literals, that define
+        on_register or that derive from other classes than BotPlugin are
+        loaded at start (see scan_commands).
     """
 
 
@@ -46,20 +168,119 @@ class PlugBot(object):
         """
         self.cmd_plugins = PluginDict(plugin_base_class = BotPlugin, default_package = default_package)
         self.cmd_plugins.bot = self
+        self.__signatures = {}
+        self.__digests = {}
 
         PlugBot.start(self)
 
-    def register_cmd_plugins(self):
+    def register_cmd_plugins(self, plugins = None):
         """ Registers all bot plugins required by botconfig.
+            Plugins are registered concurrently unless <bot workers='1'>
+            (see PluginDict.register_parallel).
+                plugins -- <plugin> elements to register (default all)
         """
-        plugins = self.botconfig.findall('plugins/bot/plugin')
-        if plugins:
+        if plugins is None:
+            plugins = self.botconfig.findall('plugins/bot/plugin')
+        for plugin in plugins:
+            self.__signatures[plugin.attrib['name']] = self.plugin_signature(plugin)
+        plugins = [plugin for plugin in plugins
+                   if not (plugin.attrib.get('lazy', 'false').lower() == 'true' and self.register_lazy_plugin(plugin))]
+        if not plugins:
+            return
+        options = self.botconfig.find('plugins/bot')
+        workers = int(options.attrib.get('workers', 4))
+        timeout = float(options.attrib.get('timeout', 30))
+        if workers > 1:
+            results = self.cmd_plugins.register_parallel([(plugin.attrib['name'], plugin.find('config'), plugin.attrib.get('module', '__default__'), plugin.attrib.get('package', '__default__')) for plugin in plugins], workers, timeout)
+        else:
+            results = {}
             for plugin in plugins:
-                loaded = self.cmd_plugins.register(plugin.attrib['name'], plugin.find('config'), plugin.attrib.get('module', '__default__'), plugin.attrib.get('package', '__default__'))
-                if loaded:
-                    logging.info("Registering plugin %s OK" % (plugin.attrib['name']))
-                else:
-                    logging.info("Registering plugin %s FAILED." % (plugin.attrib['name']))
+                results[plugin.attrib['name']] = self.cmd_plugins.register(plugin.attrib['name'], plugin.find('config'), plugin.attrib.get('module', '__default__'), plugin.attrib.get('package', '__default__'))
+        for plugin in plugins:
+            loaded = results.get(plugin.attrib['name'])
+            if loaded:
+                logging.info("Registering plugin %s OK" % (plugin.attrib['name']))
+            elif loaded is None and plugin.attrib['name'] in results:
+                logging.info("Registering plugin %s TIMED OUT, still registering." % (plugin.attrib['name']))
+            else:
+                logging.info("Registering plugin %s FAILED." % (plugin.attrib['name']))
+
+    def register_lazy_plugin(self, plugin):
+        """ Registers the placeholder of a lazy plugin.
+                plugin -- <plugin> element of botconfig
+
+            Returns False if the plugin has to be loaded at start.
+        """
+        name = plugin.attrib['name']
+        module = plugin.attrib.get('module', '__default__')
+        package = plugin.attrib.get('package', '__default__')
+        if name in self.cmd_plugins:
+            return True
+        try:
+            commands = scan_commands(self.cmd_plugins.source(name, module, package), name)
+        except Exception, e:
+            logging.warning("Plugin %s can not be lazy, loading it now: %s" % (name, e))
+            return False
+        lazy = (plugin.find('config'), module, package)
+        self.cmd_plugins[name] = lazy_plugin_class(name, commands)(plugin.find('config'), lazy)
+        logging.info("Registering plugin %s OK (lazy, %d commands)" % (name, len(commands)))
+        return True
+
+    def plugin_signature(self, plugin):
+        """ Returns a tuple (<plugin> element as text, digest of the module source)
+            that changes when the plugin has to be reloaded.
+                plugin -- <plugin> element of botconfig
+        """
+        try:
+            path = self.cmd_plugins.source(plugin.attrib['name'], plugin.attrib.get('module', '__default__'),
+                                           plugin.attrib.get('package', '__default__'))
+        except ImportError:
+            return (ET.tostring(plugin).strip(), None)
+        stat = os.stat(path)
+        (mtime, size, digest) = self.__digests.get(path, (None, None, None))
+        if (mtime, size) != (stat.st_mtime, stat.st_size):
+            digest = hashlib.md5(open(path, 'rb').read()).hexdigest()
+            self.__digests[path] = (stat.st_mtime, stat.st_size, digest)
+        return (ET.tostring(plugin).strip(), digest)
+
+    def plugin_changes(self):
+        """ Compares the plugins in botconfig with the registered ones.
+            Plugins still registering are left alone (a warning is logged if
+            they changed).
+            Returns a tuple (names to unregister, names whose module changed,
+                             <plugin> elements to register)
+        """
+        plugins = self.botconfig.findall('plugins/bot/plugin')
+        signatures = dict([(plugin.attrib['name'], self.plugin_signature(plugin)) for plugin in plugins])
+        remove = [name for name in self.cmd_plugins.keys()
+                  if signatures.get(name) != self.__signatures.get(name)]
+        changed = set([name for name in remove if name in signatures and
+                       signatures[name][1] != self.__signatures.get(name, (None, None))[1]])
+        registering = self.cmd_plugins.registering()
+        for name in registering:
+            if signatures.get(name) != self.__signatures.get(name):
+                logging.warning("Plugin %s is still registering with its previous config or source, "
+                                "rehash again once it finishes to apply the changes" % name)
+        add = [plugin for plugin in plugins
+               if plugin.attrib['name'] in remove or not (plugin.attrib['name'] in self.cmd_plugins
+                                                          or plugin.attrib['name'] in registering)]
+        return (remove, changed, add)
+
+    def apply_plugin_changes(self, changes):
+        """ Unregisters, reloads and registers plugins (see plugin_changes).
+        """
+        (remove, changed, add) = changes
+        modules = set([self.cmd_plugins[name].__module__ for name in changed
+                       if self.cmd_plugins[name].lazy is None])
+        for name in remove:
+            del self.cmd_plugins[name]
+            self.__signatures.pop(name, None)
+        for module in modules:
+            logging.info("Reloading module %s" % module)
+            reload(__import__(module, fromlist = ['__name__']))
+        if add:
+            self.register_cmd_plugins(add)
+        logging.info("%d plugins unregistered, %d modules reloaded, %d plugins registered" % (len(remove), len(modules), len(add)))
 
     def stop(self):
         """ Unregister command plugins
@@ -67,6 +288,7 @@ class PlugBot(object):
         logging.info("Stopping PlugBot")
         for plugin in self.cmd_plugins.keys():
             del self.cmd_plugins[plugin]
+        self.__signatures = {}
 
     def start(self):
         """ Register command plugins
@@ -9,39 +9,69 @@ __license__ = 'MIT License/X11 license'
 import logging
 import inspect
 import imp
+import sys
+import threading
+import time
+
+from functools import wraps
 
 from collections import defaultdict
 
+import metrics
+
+REGISTER_SECONDS = metrics.registry.gauge('sleekbot_plugin_register_seconds', 'Time spent registering a plugin', ('plugin', ))
+
 def call_on_register(plugin_name):
     """ Decorator to relate a plugin method to the event of another plugin
-         being registered
+         being registered. The method receives the registered plugin.
+         When plugins are registered concurrently, the related plugins are
+         registered first.
             plugin_name -- the name of the plugin or an iterable with plugin names
     """
+    if isinstance(plugin_name,  str):
+        plugin_name = (plugin_name,  )
     def __outer(f):
+        @wraps(f)
         def __inner(*args, **kwargs):
             return f(*args, **kwargs)
-        if isinstace(plugin_name,  'str'):
-            plugin_name = (plugin_name,  )
-        __inner._call_on_register = plugin_name
+        __inner._call_on_register = tuple(plugin_name)
+        return __inner
     return __outer
 
 def call_on_unregister(plugin_name):
     """ Decorator to relate a plugin method to the event of another plugin
-         being unregistered
+         being unregistered. The method receives the unregistered plugin.
             plugin_name -- the name of the plugin or an iterable with plugin names
     """
+    if isinstance(plugin_name,  str):
+        plugin_name = (plugin_name,  )
     def __outer(f):
+        @wraps(f)
         def __inner(*args, **kwargs):
             return f(*args, **kwargs)
-        if isinstace(plugin_name,  'str'):
-            plugin_name = (plugin_name,  )
-        __inner._call_on_unregister = plugin_name
+        __inner._call_on_unregister = tuple(plugin_name)
+        return __inner
     return __outer
 
+def plugin_dependencies(aclass):
+    """ Returns the set of plugin names related to a plugin class through
+        call_on_register.
+    """
+    names = set()
+    for name, action in inspect.getmembers(aclass):
+        names.update(getattr(action, '_call_on_register', ()))
+    return names
+
 class Plugin(object):
     """ A base class for plugins.
+        lazy -- None for a real plugin. A placeholder registered in place of a
+                plugin that has not been imported yet sets it to the tuple
+                (config, module, package) used to load the real one
+                (see PluginDict.activate).
     """
 
+    lazy = None
+
     def __init__(self,  config = {}):
         self.config = config
         self.__plugin_dict = None
@@ -52,17 +82,20 @@ class Plugin(object):
     def on_unregister(self):
         pass
 
+    def _registered(self):
+        """ Called by PluginDict once on_register finished.
+        """
+        pass
+
     def _register_calls(self):
         for name, action in inspect.getmembers(self):
             if inspect.ismethod(action) and hasattr(action, '_call_on_register'):
                 for related in action._call_on_register:
                     if related in self.__plugin_dict:
-                        action(related)
+                        action(self.__plugin_dict[related])
                     self.__plugin_dict._call_on_register[related].add((self, action))
             if inspect.ismethod(action) and hasattr(action, '_call_on_unregister'):
                 for related in action._call_on_unregister:
-                    if related in self.__plugin_dict:
-                        action(related)
                     self.__plugin_dict._call_on_unregister[related].add((self, action))
 
     def _get_dict(self):
@@ -95,8 +128,10 @@ class PluginDict(dict):
         self._plugin_base_class = plugin_base_class
         self._default_factory = default_factory
         self._default_package = default_package
-        self.__call_on_register = defaultdict(set)
-        self.__call_on_unregister = defaultdict(set)
+        self._call_on_register = defaultdict(set)
+        self._call_on_unregister = defaultdict(set)
+        self.__lock = threading.RLock()
+        self.__registering = set()
         __import__(default_package)
         self.__imported = set()
         self.__imported.add(default_package)
@@ -112,12 +147,30 @@ class PluginDict(dict):
         if not isinstance(value, self._plugin_base_class):
             raise NotAPluginError(value.__name__)
 
-        value.plugin_dict = self
-        value.on_register()
-        for event in self.__call_on_register[key]:
-            event[1](value)
-
-        return super(PluginDict, self).__setitem__(key, value)
+        started = time.time()
+        with self.__lock:
+            self.__registering.add(key)
+            value.plugin_dict = self
+        try:
+            value.on_register()
+            if value.lazy is None:
+                REGISTER_SECONDS.set(time.time() - started, (key, ))
+            with self.__lock:
+                value._registered()
+                if value.lazy is None:
+                    for event in list(self._call_on_register[key]):
+                        event[1](value)
+                return super(PluginDict, self).__setitem__(key, value)
+        finally:
+            with self.__lock:
+                self.__registering.discard(key)
+
+    def registering(self):
+        """ Returns the set of names of the plugins whose registration has
+            started but not finished (on_register still running).
+        """
+        with self.__lock:
+            return set(self.__registering)
 
     def __delitem__(self, key):
         """ Call plugin.on_unregister and then remove it form the dictionary
@@ -125,8 +178,9 @@ class PluginDict(dict):
         if key in self:
             current = super(PluginDict, self).__getitem__(key)
             current.on_unregister()
-            for event in self.__call_on_unregister[key]:
-                event[1](current)
+            if current.lazy is None:
+                for event in list(self._call_on_unregister[key]):
+                    event[1](current)
             self._unregister_event(key)
             current.plugin_dict = None
             logging.info("%s unregistered" % key)
@@ -140,31 +194,144 @@ class PluginDict(dict):
                 name    -- plugin name (name of the class)
                 config  -- extra configuration (to be handled to the plugin)
                 package -- where the plugin is declared
+
+            Returns True if the plugin is registered (or being registered),
+            False if it failed.
         """
         try:
-            if name in self:
-                return
-            if isinstance(name,  self._plugin_base_class):
-                plugin = name
-                name = name.__class__.__name__
-                self[name] = plugin
-            elif isinstance(name,  str):
-                if package == '__default__':
-                    package = self._default_package
-                elif not package in self.__imported:
-                    __import__(package)
-                    self.__imported.add(package)
-                    logging.debug('Imported package %s' % package)
-                if module == '__default__':
-                    module = name
-
-                imported = __import__("%s.%s" % (package, module), fromlist = name)
-                self[name] = self._default_factory(getattr(imported, name),  config)
-
+            if name in self or name in self.registering():
+                return True
+            (name, plugin) = self.load(name, config, module, package)
+            self[name] = plugin
             return True
 
         except Exception,  e:
             logging.error('Error while registering plugin %s: %s' % (name,  e))
+            return False
+
+    def load(self, name, config = {}, module = '__default__', package = '__default__'):
+        """ Imports and instantiates a plugin without registering it.
+            Arguments as in register. Returns a tuple (name, plugin).
+        """
+        if isinstance(name,  self._plugin_base_class):
+            return (name.__class__.__name__, name)
+        if package == '__default__':
+            package = self._default_package
+        elif not package in self.__imported:
+            __import__(package)
+            self.__imported.add(package)
+            logging.debug('Imported package %s' % package)
+        if module == '__default__':
+            module = name
+
+        imported = __import__("%s.%s" % (package, module), fromlist = name)
+        return (name, self._default_factory(getattr(imported, name),  config))
+
+    def source(self, name, module = '__default__', package = '__default__'):
+        """ Returns the path of the file declaring a plugin without importing it.
+            Arguments as in register.
+        """
+        if package == '__default__':
+            package = self._default_package
+        elif not package in self.__imported:
+            __import__(package)
+            self.__imported.add(package)
+        if module == '__default__':
+            module = name
+        (f, path, description) = imp.find_module(module, sys.modules[package].__path__)
+        if f:
+            f.close()
+        return path
+
+    def activate(self, name):
+        """ Replaces a lazy placeholder by the real plugin, importing and
+            registering it. Returns the registered plugin.
+        """
+        with self.__lock:
+            plugin = self.get(name)
+            if plugin is None or plugin.lazy is None:
+                return plugin
+            (config, module, package) = plugin.lazy
+            del self[name]
+            started = time.time()
+            self.register(name, config, module, package)
+            logging.info("Activated lazy plugin %s in %.3f s" % (name, time.time() - started))
+            return self.get(name)
+
+    def register_parallel(self, plugins, workers = 4, timeout = 30):
+        """ Loads and registers plugins running their on_register concurrently.
+            A plugin waits for the plugins it relates to through call_on_register.
+            Errors are isolated per plugin. A plugin whose registration takes
+            longer than timeout is left finishing in the background.
+
+                plugins -- iterable of (name, config, module, package) tuples
+                workers -- number of plugins registered at the same time (default 4)
+                timeout -- seconds to wait for each plugin (default 30)
+
+            Returns a dict name: True (registered), False (failed) or None (timed out)
+        """
+        results = {}
+        loaded = []
+        registering = self.registering()
+        for (name, config, module, package) in plugins:
+            if name in self or name in registering:
+                continue
+            try:
+                loaded.append(self.load(name, config, module, package))
+            except Exception, e:
+                logging.error('Error while registering plugin %s: %s' % (name,  e))
+                results[name] = False
+
+        names = set([name for (name, plugin) in loaded])
+        waiting = [(name, plugin, plugin_dependencies(plugin.__class__) & names - set([name]))
+                   for (name, plugin) in loaded]
+        done = threading.Condition(threading.Lock())
+        started = {}
+        finished = set(results.keys())
+
+        def run(name, plugin):
+            try:
+                self[name] = plugin
+                result = True
+            except Exception, e:
+                logging.error('Error while registering plugin %s: %s' % (name,  e))
+                result = False
+            with done:
+                if results.get(name, True) is None:
+                    logging.info("Plugin %s finished registering after its timeout" % name)
+                results[name] = result
+                finished.add(name)
+                done.notify_all()
+
+        with done:
+            while waiting or len(started) > len([n for n in started if n in finished]):
+                now = time.time()
+                running = [n for n in started if n not in finished]
+                for n in running:
+                    if now - started[n] > timeout:
+                        logging.warning("Plugin %s did not register in %s seconds, continuing in background" % (n, timeout))
+                        results[n] = None
+                        finished.add(n)
+                running = [n for n in started if n not in finished]
+                for item in list(waiting):
+                    if len(running) >= workers:
+                        break
+                    (name, plugin, deps) = item
+                    if deps <= finished:
+                        waiting.remove(item)
+                        started[name] = time.time()
+                        running.append(name)
+                        thread = threading.Thread(target = run, args = (name, plugin), name = 'register-%s' % name)
+                        thread.daemon = True
+                        thread.start()
+                if not running and waiting:
+                    logging.error("Circular call_on_register between plugins %s" % ', '.join([w[0] for w in waiting]))
+                    for (name, plugin, deps) in waiting:
+                        results[name] = False
+                    break
+                if running:
+                    done.wait(min([started[n] + timeout for n in running]) - time.time())
+        return results
 
     def register_many(self, include = '__all__', exclude = set(), config = dict()):
         """ Register multiple plugins
@@ -183,6 +350,8 @@ class PluginDict(dict):
     def reload(self, name, config = {}):
         """ Reload a registered plugins.
         """
+        if self[name].lazy is not None:
+            return
         config = getattr(self[name], 'config',  {})
         module = __import__(self[name].__module__, fromlist = name)
         del self[name]
@@ -199,13 +368,15 @@ class PluginDict(dict):
     def _unregister_event(self, plugin):
         """ Unregister events associated with a plugin
         """
-        for v in self.__call_on_register.values():
-            v = set(filter(lambda x: x[0] != plugin, v))
-        for v in self.__call_on_unregister.values():
-            v = set(filter(lambda x: x[0] != plugin, v))
+        plugin = super(PluginDict, self).__getitem__(plugin)
+        for v in self._call_on_register.values():
+            v.difference_update([x for x in v if x[0] is plugin])
+        for v in self._call_on_unregister.values():
+            v.difference_update([x for x in v if x[0] is plugin])
 
     def get_modules(self):
-            return [__import__(self[name].__module__, fromlist = name) for name in self.keys()]
+            return [__import__(self[name].__module__, fromlist = name) for name in self.keys()
+                    if self[name].lazy is None]
 
 class NotAPluginError(Exception):
     """Exception raised when the object added to PluginDict is
@@ -146,3 +146,14 @@ class info(BotPlugin):
     def mem(self, command, args, msg):
         """See how much memory python is using"""
         return '%s\n' % self.hpy.heap()
+
+
+    @botcmd(usage = '[reset|metric prefix]', allow=CommandBot.msg_from_owner)
+    def stats(self, command, args, msg):
+        """See the metrics collected by the bot"""
+        if not self.bot.metrics.enabled:
+            return "Metrics are disabled. Add <metrics enabled='true' /> to the config."
+        if args.strip() == 'reset':
+            self.bot.metrics.clear()
+            return "Metrics reset"
+        return self.bot.metrics.summary(args.strip()) or "No metrics yet"
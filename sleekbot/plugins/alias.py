@@ -17,6 +17,7 @@ the user has precedence. -->
 
 import re
 import logging
+import types
 
 from sleekbot.commandbot import botcmd, botfreetxt
 from sleekbot.plugbot import BotPlugin
@@ -45,62 +46,52 @@ class aliasstore(object):
                                        "jid" TEXT NOT NULL, "alias" TEXT NOT NULL,
                                        "command" TEXT NOT NULL)""")
         db.close()
+        self.store.ensure_unique_index('alias', 'idx_alias_jid_alias', ('jid', 'alias'))
 
     def update(self, alias):
-        db = self.store.getDb()
-        cur = db.cursor()
-        cur.execute('SELECT * FROM alias WHERE jid=? AND alias=?', (alias.jid, alias.alias))
-        if (len(cur.fetchall()) > 0):
-            cur.execute('UPDATE alias SET jid=?, command=?, alias=? WHERE jid=? AND alias=?', (alias.jid, alias.command, alias.alias, alias.jid, alias.alias))
-        else:
-            cur.execute('INSERT INTO alias(jid, command, alias) VALUES(?,?,?)', (alias.jid, alias.command, alias.alias))
-        db.commit()
-        db.close()
+        with self.store.context_cursor() as cur:
+            cur.execute("""INSERT INTO alias(jid, command, alias) VALUES(?,?,?)
+                           ON CONFLICT(jid, alias) DO UPDATE SET command=excluded.command""",
+                        (alias.jid, alias.command, alias.alias))
 
     def get(self, alias):
-        db = self.store.getDb()
-        cur = db.cursor()
-        cur.execute('SELECT * FROM alias WHERE jid=? AND alias=?', (alias.jid, alias.alias))
-        results = cur.fetchall()
-        if len(results) == 0:
+        with self.store.context_cursor() as cur:
+            cur.execute('SELECT jid, alias, command FROM alias WHERE jid=? AND alias=?', (alias.jid, alias.alias))
+            result = cur.fetchone()
+        if result is None:
             return None
-        return aliascmd(results[0][1],results[0][2],results[0][3])
-        db.close()
+        return aliascmd(result[0],result[1],result[2])
 
     def get_all(self, jid):
-        db = self.store.getDb()
-        cur = db.cursor()
-        cur.execute('SELECT * FROM alias WHERE jid=?', (jid,))
-        results = cur.fetchall()
+        with self.store.context_cursor() as cur:
+            cur.execute('SELECT jid, alias, command FROM alias WHERE jid=?', (jid,))
+            results = cur.fetchall()
         if len(results) == 0:
             return None
         response = []
         for result in results:
-            response.append(aliascmd(result[1],result[2],result[3]))
+            response.append(aliascmd(result[0],result[1],result[2]))
         return response
 
     def delete(self, alias):
-        db = self.store.getDb()
-        cur = db.cursor()
-        cur.execute('DELETE FROM alias WHERE jid=? AND alias=?', (alias.jid, alias.alias))
-        db.commit()
-        db.close()
+        with self.store.context_cursor() as cur:
+            cur.execute('DELETE FROM alias WHERE jid=? AND alias=?', (alias.jid, alias.alias))
 
 class alias(BotPlugin):
     """ A plugin for global and user defined aliases.
     """
 
-    freetextRegex = ''
-
     def on_register(self):
         self.im_prefix = self.bot.im_prefix
         self.muc_prefix = self.bot.muc_prefix
         self.aliasstore = aliasstore(self.bot.store)
 
-        # botfreetext regex string with im and mux prefix
-        global freetextRegex
+        # botfreetext regex string with im and mux prefix. The handler is
+        # declared here because the regex depends on the configured prefixes
+        # (commands are registered after on_register)
         freetextRegex = "^[\%s\%s][a-zA-Z].*$" % (self.im_prefix,
                                                   self.muc_prefix)
+        self.handle_alias = types.MethodType(botfreetxt(priority=1, regex=re.compile(freetextRegex))(self.find_alias.im_func), self)
 
         # global aliases
         self.global_aliases = {}
@@ -111,35 +102,24 @@ class alias(BotPlugin):
                                                   alias.attrib['name'],
                                                   alias.attrib['command'])
 
-    @botfreetxt(priority=1, regex=freetextRegex)
-    def handle_alias(self, text, msg, command_found, freetext_found, match):
-        """ Botfreetext handler that match global or user defined
+    def find_alias(self, text, msg, command_found, freetext_found, match):
+        """ Botfreetext handler (handle_alias) that match global or user defined
             aliases. The aliased command replaces the msg['body']
-            which is then routed again to self.bot.handle_msg_botcmd(msg).
+            which is then routed again to self.bot.dispatch_msg(msg).
         """
 
         if command_found is True:
             return
-        if msg['type'] == 'groupchat':
-            prefix = self.muc_prefix
-        else:
-            prefix = self.im_prefix
-        command = msg.get('body', '').strip().split(' ', 1)[0]
-        if ' ' in msg.get('body', ''):
-            args = msg['body'].split(' ', 1)[-1].strip()
-        else:
-            args = ''
-        if command.startswith(prefix):
-            if len(prefix):
-                command = command.split(prefix, 1)[-1]
+        (body, prefix, command, args) = self.bot.parse_msg(msg)
+        if command is not None:
             alias = self.aliasstore.get(aliascmd(self.bot.get_real_jid(msg), command))
             if not alias is None:
                 msg['body'] = "%s%s %s" % (prefix, alias.command, args)
-                self.bot.handle_msg_botcmd(msg)
+                self.bot.dispatch_msg(msg)
             elif self.global_aliases.has_key(command):
                 alias = self.global_aliases[command]
                 msg['body'] = "%s%s %s" % (prefix, alias.command, args)
-                self.bot.handle_msg_botcmd(msg)
+                self.bot.dispatch_msg(msg)
 
     @botcmd(usage='[list|add|delete] [alias] [command] [options]')
     def alias(self, command, args, msg):
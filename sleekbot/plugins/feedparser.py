@@ -378,6 +378,7 @@ class _FeedParserMixin:
         self.insource = 0
         self.sourcedata = FeedParserDict()
         self.contentparams = FeedParserDict()
+        self.date_memo = {} # date handler that parsed the last date of the feed
         self._summaryKey = None
         self.namespacemap = {}
         self.elementstack = []
@@ -1053,7 +1054,7 @@ class _FeedParserMixin:
 
     def _end_published(self):
         value = self.pop('published')
-        self._save('published_parsed', _parse_date(value))
+        self._save('published_parsed', _parse_date(value, self.date_memo))
     _end_dcterms_issued = _end_published
     _end_issued = _end_published
 
@@ -1066,7 +1067,7 @@ class _FeedParserMixin:
 
     def _end_updated(self):
         value = self.pop('updated')
-        parsed_value = _parse_date(value)
+        parsed_value = _parse_date(value, self.date_memo)
         self._save('updated_parsed', parsed_value)
     _end_modified = _end_updated
     _end_dcterms_modified = _end_updated
@@ -1079,14 +1080,14 @@ class _FeedParserMixin:
 
     def _end_created(self):
         value = self.pop('created')
-        self._save('created_parsed', _parse_date(value))
+        self._save('created_parsed', _parse_date(value, self.date_memo))
     _end_dcterms_created = _end_created
 
     def _start_expirationdate(self, attrsD):
         self.push('expired', 1)
 
     def _end_expirationdate(self):
-        self._save('expired_parsed', _parse_date(self.pop('expired')))
+        self._save('expired_parsed', _parse_date(self.pop('expired'), self.date_memo))
 
     def _start_cc_license(self, attrsD):
         self.push('license', 1)
@@ -1834,6 +1835,11 @@ _date_handlers = []
 def registerDateHandler(func):
     '''Register a date handler function (takes string, returns 9-tuple date in GMT)'''
     _date_handlers.insert(0, func)
+    _date_cache.clear()
+
+# recently parsed date strings (feeds repeat the same dates on every poll)
+_date_cache = {}
+_DATE_CACHE_SIZE = 1024
     
 # ISO-8601 date parsing routines written by Fazal Majid.
 # The ISO 8601 standard is very convoluted and irregular - a full ISO 8601
@@ -2223,21 +2229,51 @@ _additional_timezones = {'AT': -400, 'ET': -500, 'CT': -600, 'MT': -700, 'PT': -
 rfc822._timezones.update(_additional_timezones)
 registerDateHandler(_parse_date_rfc822)    
 
-def _parse_date(dateString):
-    '''Parses a variety of date formats into a 9-tuple in GMT'''
-    for handler in _date_handlers:
-        try:
-            date9tuple = handler(dateString)
-            if not date9tuple: continue
-            if len(date9tuple) != 9:
-                if _debug: sys.stderr.write('date handler function must return 9-tuple\n')
-                raise ValueError
-            map(int, date9tuple)
-            return date9tuple
-        except Exception, e:
-            if _debug: sys.stderr.write('%s raised %s\n' % (handler.__name__, repr(e)))
-            pass
-    return None
+def _call_date_handler(handler, dateString):
+    '''Returns the 9-tuple parsed by handler, or None if it fails'''
+    try:
+        date9tuple = handler(dateString)
+        if not date9tuple: return None
+        if len(date9tuple) != 9:
+            if _debug: sys.stderr.write('date handler function must return 9-tuple\n')
+            raise ValueError
+        map(int, date9tuple)
+        return date9tuple
+    except Exception, e:
+        if _debug: sys.stderr.write('%s raised %s\n' % (handler.__name__, repr(e)))
+        return None
+
+def _parse_date(dateString, memo=None):
+    '''Parses a variety of date formats into a 9-tuple in GMT
+
+    memo is a dictionary shared by the dates of a feed; the handler that
+    parsed the last date is tried first, as a feed uses the same format.
+    The last handler (ISO-8601) accepts dates meant for others and is not
+    remembered.
+    '''
+    try:
+        return _date_cache[dateString]
+    except (KeyError, TypeError):
+        pass
+    date9tuple = None
+    last = memo is not None and memo.get('handler')
+    if last:
+        date9tuple = _call_date_handler(last, dateString)
+    if date9tuple is None:
+        for handler in _date_handlers:
+            if handler is last: continue
+            date9tuple = _call_date_handler(handler, dateString)
+            if date9tuple is not None:
+                if memo is not None and handler is not _date_handlers[-1]:
+                    memo['handler'] = handler
+                break
+    if len(_date_cache) >= _DATE_CACHE_SIZE:
+        _date_cache.clear()
+    try:
+        _date_cache[dateString] = date9tuple
+    except TypeError:
+        pass
+    return date9tuple
 
 def _getCharacterEncoding(http_headers, xml_data):
     '''Get the character encoding of the XML document
@@ -2485,7 +2521,13 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
                 result['bozo_exception'] = e
                 data = ''
 
-    # save HTTP headers
+    _save_headers(result, f)
+    if hasattr(f, 'close'):
+        f.close()
+    return _parse_data(result, data)
+
+def _save_headers(result, f):
+    '''Save the HTTP headers of the response f in result'''
     if hasattr(f, 'info'):
         info = f.info()
         result['etag'] = info.getheader('ETag')
@@ -2499,9 +2541,9 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
         result['status'] = f.status
     if hasattr(f, 'headers'):
         result['headers'] = f.headers.dict
-    if hasattr(f, 'close'):
-        f.close()
 
+def _parse_data(result, data):
+    '''Parse the (decompressed) data of a feed into result'''
     # there are four encodings to keep track of:
     # - http_encoding is the encoding declared in the Content-Type HTTP header
     # - xml_encoding is the encoding declared in the <?xml declaration
@@ -2627,6 +2669,186 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
     result['namespaces'] = feedparser.namespacesInUse
     return result
 
+# encodings the SAX parser reads directly, without converting the data to utf-8
+_STREAMABLE_ENCODINGS = ('utf-8', 'utf8', 'us-ascii', 'ascii')
+
+class FeedIterator:
+    '''Iterates over the entries of a feed as they are parsed (see iterparse)
+
+    result is a FeedParserDict like the one returned by parse, filled with the
+    HTTP data (status, headers, etag, modified, href) when the iterator is
+    created and with the feed data as the document is parsed.  The entries
+    are not kept in result['entries'].
+    '''
+
+    def __init__(self, url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[], chunk_size=16384):
+        self.chunk_size = chunk_size
+        self.result = result = FeedParserDict()
+        result['feed'] = FeedParserDict()
+        result['entries'] = []
+        if _XML_AVAILABLE:
+            result['bozo'] = 0
+        if type(handlers) == types.InstanceType:
+            handlers = [handlers]
+        self._decompressor = None
+        try:
+            self._f = _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, handlers)
+        except Exception, e:
+            result['bozo'] = 1
+            result['bozo_exception'] = e
+            self._f = None
+            return
+        _save_headers(result, self._f)
+        if hasattr(self._f, 'headers'):
+            encoding = self._f.headers.get('content-encoding', '')
+            if zlib and encoding == 'gzip':
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif zlib and encoding == 'deflate':
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def close(self):
+        if self._f is not None and hasattr(self._f, 'close'):
+            self._f.close()
+        self._f = None
+
+    def _read(self):
+        '''Returns the next chunk of decompressed data, '' at the end'''
+        while self._f is not None:
+            data = self._f.read(self.chunk_size)
+            if not data:
+                if self._decompressor:
+                    data = self._decompressor.flush()
+                    self._decompressor = None
+                    if data:
+                        return data
+                self.close()
+                return ''
+            if self._decompressor:
+                try:
+                    data = self._decompressor.decompress(data)
+                except Exception, e:
+                    self.result['bozo'] = 1
+                    self.result['bozo_exception'] = e
+                    self.close()
+                    return ''
+                if not data:
+                    continue
+            return data
+        return ''
+
+    def _readall(self, chunks):
+        while 1:
+            data = self._read()
+            if not data:
+                return ''.join(chunks)
+            chunks.append(data)
+
+    def __iter__(self):
+        try:
+            for entry in self._entries():
+                yield entry
+        finally:
+            self.close()
+
+    def _entries(self):
+        result = self.result
+        if self._f is None or result.get('status', 0) == 304:
+            _parse_data(result, self._readall([]))
+            return
+        # read the prolog: up to the start of the root element
+        chunks = []
+        head = ''
+        while 1:
+            data = self._read()
+            if not data:
+                break
+            chunks.append(data)
+            head += data
+            if re.search(r'<[^?!]', head):
+                break
+        if not head:
+            return
+        http_headers = result.get('headers', {})
+        result['encoding'], http_encoding, xml_encoding, sniffed_xml_encoding, acceptable_content_type = \
+            _getCharacterEncoding(http_headers, head)
+        streamable = _XML_AVAILABLE and acceptable_content_type and \
+            (result['encoding'] or '').lower() in _STREAMABLE_ENCODINGS and \
+            (xml_encoding or 'utf-8').lower() in _STREAMABLE_ENCODINGS
+        if not streamable:
+            # let parse deal with the encoding and malformed feeds
+            _parse_data(result, self._readall(chunks))
+            for entry in result['entries']:
+                yield entry
+            result['entries'] = []
+            return
+        result['version'], head = _stripDoctype(head)
+        baseuri = http_headers.get('content-location', result.get('href'))
+        baselang = http_headers.get('content-language', None)
+        feedparser = _StrictFeedParser(baseuri, baselang, 'utf-8')
+        saxparser = xml.sax.make_parser(PREFERRED_XML_PARSERS)
+        saxparser.setFeature(xml.sax.handler.feature_namespaces, 1)
+        saxparser.setContentHandler(feedparser)
+        saxparser.setErrorHandler(feedparser)
+        if hasattr(saxparser, '_ns_stack'):
+            # work around bug in built-in SAX parser (doesn't recognize xml: namespace)
+            saxparser._ns_stack.append({'http://www.w3.org/XML/1998/namespace':'xml'})
+        result['feed'] = feedparser.feeddata
+        result['namespaces'] = feedparser.namespacesInUse
+        # chunks keeps the data read until the first entry is returned, to
+        # parse it again with parse if the strict parser fails before that
+        data = head
+        while data:
+            try:
+                saxparser.feed(data)
+            except Exception, e:
+                result['bozo'] = 1
+                result['bozo_exception'] = feedparser.exc or e
+                if chunks is not None:
+                    result['feed'] = FeedParserDict()
+                    _parse_data(result, self._readall(chunks))
+                    for entry in result['entries']:
+                        yield entry
+                    result['entries'] = []
+                return
+            result['version'] = result['version'] or feedparser.version
+            complete = len(feedparser.entries) - (feedparser.inentry and 1 or 0)
+            if complete > 0:
+                entries = feedparser.entries[:complete]
+                del feedparser.entries[:complete]
+                chunks = None
+                for entry in entries:
+                    yield entry
+            data = self._read()
+            if chunks is not None:
+                chunks.append(data)
+        try:
+            saxparser.close()
+        except Exception, e:
+            result['bozo'] = 1
+            result['bozo_exception'] = feedparser.exc or e
+            if chunks is not None:
+                result['feed'] = FeedParserDict()
+                _parse_data(result, ''.join(chunks))
+                for entry in result['entries']:
+                    yield entry
+                result['entries'] = []
+                return
+        for entry in feedparser.entries:
+            yield entry
+        del feedparser.entries[:]
+
+def iterparse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[], chunk_size=16384):
+    '''Parse a feed from a URL, file, stream, or string yielding its entries
+    as they are parsed, so a caller can stop reading a large feed early.
+
+    Returns a FeedIterator.  Its result attribute holds the rest of what parse
+    returns.  Documents that are not utf-8 (or ascii) are parsed with parse
+    before the first entry is returned, and so are malformed documents when
+    the error is found before the first entry is complete.  An error found
+    later sets bozo and ends the iteration.
+    '''
+    return FeedIterator(url_file_stream_or_string, etag, modified, agent, referrer, handlers, chunk_size)
+
 if __name__ == '__main__':
     if not sys.argv[1:]:
         print __doc__
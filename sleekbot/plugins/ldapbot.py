@@ -113,7 +113,7 @@ class ldapbot(BotPlugin):
         except ldap.LDAPError as e:
             logging.error('LDAP %s' % e)
 
-    @botcmd(name='ldap', usage=options) # options is global
+    @botcmd(name='ldap', usage=options, max_concurrency=2, timeout=30) # options is global
     def handle_ldapsearch(self, command, args, msg):
         """ Achieve a query on a LDAP Server."""
 
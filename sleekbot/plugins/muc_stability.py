@@ -5,7 +5,6 @@
 
 import logging
 import datetime, time
-import thread
 
 from sleekxmpp.xmlstream.handler.callback import Callback
 from sleekxmpp.xmlstream.matcher.xmlmask import MatchXMLMask
@@ -16,18 +15,19 @@ class muc_stability(BotPlugin):
     """Attempts to keep Sleek in muc channels."""
 
     def on_register(self):
-        self.shuttingDown = False
-        thread.start_new(self.loop, ())
+        self.task = self.bot.tasks.call_every(540, self.check)
         self.bot.registerHandler(Callback("groupchat_error", MatchXMLMask("<message xmlns='jabber:client' type='error'><error type='modify' code='406' ><not-acceptable xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/></error></message>"), self.handle_message_error))
 
-    def loop(self):
+    def on_unregister(self):
+        self.task.cancel()
+        self.bot.removeHandler("groupchat_error")
+
+    def check(self):
         """Perform the muc checking."""
-        while not self.shuttingDown:
-            if self.bot.plugin['xep_0045']:
-                for muc in self.bot.plugin['xep_0045'].getJoinedRooms():
-                    jid = self.bot.plugin['xep_0045'].getOurJidInRoom(muc)
-                    self.bot.sendMessage(jid, None, mtype='chat')
-            time.sleep(540)
+        if self.bot.plugin['xep_0045']:
+            for muc in self.bot.plugin['xep_0045'].getJoinedRooms():
+                jid = self.bot.plugin['xep_0045'].getOurJidInRoom(muc)
+                self.bot.send_message(jid, None, mtype='chat')
 
     def handle_message_error(self, msg):
         """ On error messages, see if it's from a muc, and rejoin the muc if so.
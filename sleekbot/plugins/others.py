@@ -21,7 +21,7 @@ class others(BotPlugin):
             [muc, text] = args.split(" ",1)
         else:
             return "Insufficient parameters"
-        self.bot.sendMessage(muc, text, mtype='groupchat')
+        self.bot.send_message(muc, text, mtype='groupchat')
         return "Sent."
 
 
@@ -34,11 +34,11 @@ class others(BotPlugin):
             [jid, text] = args.split(" ",1)
         else:
             return "Insufficient parameters"
-        self.bot.sendMessage(jid, text, mtype='chat')
+        self.bot.send_message(jid, text, mtype='chat')
         return "Sent."
 
 
-    @botcmd(usage = '[jid]')
+    @botcmd(usage = '[jid]', max_concurrency=4, timeout=15)
     def ping(self, command, args, msg):
         """Discover latency to a jid."""
         latency = self.bot['xep_0199'].sendPing(args, 10)
@@ -0,0 +1,124 @@
+"""
+    This file is part of SleekBot. http://github.com/hgrecco/SleekBot
+    See the README file for more information.
+"""
+
+import logging
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from sleekbot.plugbot import BotPlugin
+
+OPENMETRICS = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+TEXT = 'text/plain; version=0.0.4; charset=utf-8'
+
+def escape(value):
+    """ Escape a label value (returns unicode, jids may not be ascii).
+    """
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def number(value):
+    """ Format a sample value.
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def labelset(names, values, extra = ()):
+    pairs = ['%s="%s"' % (name, escape(value)) for (name, value) in zip(names, values) + list(extra)]
+    if pairs:
+        return '{%s}' % ','.join(pairs)
+    return ''
+
+def exposition(registry, openmetrics = True):
+    """ Returns the metrics of registry in the OpenMetrics text format
+        (or in the Prometheus text format if openmetrics is False) as unicode.
+    """
+    lines = []
+    for metric in registry.metrics():
+        family = metric.name
+        if metric.kind == 'counter' and openmetrics and family.endswith('_total'):
+            family = family[:-len('_total')]
+        lines.append('# TYPE %s %s' % (family, metric.kind))
+        if metric.doc:
+            lines.append('# HELP %s %s' % (family, metric.doc.replace('\\', '\\\\').replace('\n', '\\n')))
+        for (labels, value) in metric.samples():
+            if metric.kind == 'histogram':
+                (cumulative, total, count) = value
+                for (bound, n) in zip(metric.buckets, cumulative):
+                    lines.append('%s_bucket%s %d' % (metric.name, labelset(metric.labels, labels, [('le', number(bound))]), n))
+                lines.append('%s_sum%s %s' % (metric.name, labelset(metric.labels, labels), number(total)))
+                lines.append('%s_count%s %d' % (metric.name, labelset(metric.labels, labels), count))
+            else:
+                name = metric.name
+                if metric.kind == 'counter' and openmetrics and not name.endswith('_total'):
+                    name += '_total'
+                lines.append('%s%s %s' % (name, labelset(metric.labels, labels), number(value)))
+    if openmetrics:
+        lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves the metrics of the registry of the server at /metrics
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+        body = exposition(self.server.registry, openmetrics).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', OPENMETRICS if openmetrics else TEXT)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("prometheus: %s - %s" % (self.address_string(), format % args))
+
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class prometheus(BotPlugin):
+    """ Serves the bot metrics to a Prometheus scraper over HTTP.
+        Metrics are enabled when the plugin is registered, so enable them in the
+        bot config (<metrics enabled='true' />) to measure the plugins
+        registered before this one.
+
+        Configuration example:
+        <plugin name="prometheus">
+            <config>
+                <http host="127.0.0.1" port="9110" />
+            </config>
+        </plugin>
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(prometheus, self).__init__(*args, **kwargs)
+        http = self.config.find('http') if self.config is not None else None
+        http = {} if http is None else http.attrib
+        self.address = (http.get('host', '127.0.0.1'), int(http.get('port', 9110)))
+        self.server = None
+
+    def on_register(self):
+        self.bot.metrics.enabled = True
+        self.server = MetricsServer(self.address, MetricsHandler)
+        self.server.registry = self.bot.metrics
+        thread = threading.Thread(target = self.server.serve_forever, name = 'prometheus')
+        thread.daemon = True
+        thread.start()
+        logging.info("prometheus: serving metrics at http://%s:%d/metrics" % self.address)
+
+    def on_unregister(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
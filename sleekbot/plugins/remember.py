@@ -7,8 +7,6 @@ import re
 import cPickle
 import logging
 import random
-import thread
-import time
 import copy
 
 from sleekbot.commandbot import botcmd
@@ -17,38 +15,45 @@ from sleekbot.plugbot import BotPlugin
 class remember(BotPlugin):
     """A plugin to rembember events."""
 
-    def __init__(self, bot, config):
-        BotPlugin.__init__(self, bot, config)
+    def on_register(self):
         self.know = []
         self.loaddefault()
-        self.idlemin = int(self.config.get('idlemin', 60))
-        self.idlemax = int(self.config.get('idlemax', 600))
+        config = self.config if self.config is not None else {}
+        self.idlemin = int(config.get('idlemin', 60))
+        self.idlemax = int(config.get('idlemax', 600))
         self.bot.add_event_handler("groupchat_message", self.handle_message_event, threaded=True)
         self.search = re.compile("""(([Tt]he|[mM]y)[\s\w\-0-9]+ (is|are|can|has|got)|I am|i am|I'm|(?=^|,|\.\s|\?)?[\w'0-9\-]+ (is|are|can|got|has))[\s\w'0-9\-:$@%^&*"]+""")
         self.prep = ["Let's see... %s.", '%s.', 'I know that %s.', 'I heard that %s.', 'Rumor has it that %s.', 'Did you hear that %s?', 'A little bird told me that %s.', '%s?!??!']
         self.running = True
         self.lastroom = None
         self.lastmessage = ''
-        thread.start_new(self.idle, tuple())
+        self.task = self.bot.tasks.call_later(random.randint(self.idlemin, self.idlemax), self.idle)
+
+    def on_unregister(self):
+        self.running = False
+        self.task.cancel()
+        self.bot.del_event_handler("groupchat_message", self.handle_message_event)
+        self.shutDown()
 
     def idle(self):
-        while self.running:
-            time.sleep(random.randint(self.idlemin, self.idlemax))
-            if self.lastroom:
-                msg = self.lastmessage.split(' ')
-                msgs = copy.copy(msg)
-                for word in msgs:
-                    if len(word) < 5:
-                        msg.remove(word)
-                while len(msg) > 0:
-                    searchword = msg[random.randint(0, len(msg) - 1)]
-                    reply = self.searchKnow(searchword)
-                    if not reply:
-                        reply = msg.remove(searchword)
-                    else:
-                        self.bot.sendMessage(self.lastroom, reply, mtype='groupchat')
-                        self.lastmessage = ''
-                        break
+        if not self.running:
+            return
+        if self.lastroom:
+            msg = self.lastmessage.split(' ')
+            msgs = copy.copy(msg)
+            for word in msgs:
+                if len(word) < 5:
+                    msg.remove(word)
+            while len(msg) > 0:
+                searchword = msg[random.randint(0, len(msg) - 1)]
+                reply = self.searchKnow(searchword)
+                if not reply:
+                    reply = msg.remove(searchword)
+                else:
+                    self.bot.send_message(self.lastroom, reply, mtype='groupchat')
+                    self.lastmessage = ''
+                    break
+        self.task = self.bot.tasks.call_later(random.randint(self.idlemin, self.idlemax), self.idle)
 
     @botcmd('know')
     def handle_know_request(self, command, args, msg):
@@ -98,7 +103,7 @@ class remember(BotPlugin):
             self.command = re.compile("^%s.*know.*?" % self.bot.rooms[msg['mucroom']])
             match = self.command.search(msg['message'])
             if match:
-                self.bot.sendMessage(msg['mucroom'], self.knowledge(), mtype='groupchat')
+                self.bot.send_message(msg['mucroom'], self.knowledge(), mtype='groupchat')
                 return
             match = self.search.search(msg['message'])
             if match:
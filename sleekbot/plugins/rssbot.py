@@ -5,65 +5,279 @@
 
 import logging
 import feedparser
-import thread
 import time
+import calendar
+import random
 import re
 import pickle
+import urlparse
+import hashlib
+
+from collections import OrderedDict
 from html2text.html2text import html2text
 
+from sleekbot.scheduler import CommandScheduler, TaskLoop
+
+#: Longest time (seconds) Cache-Control or Retry-After can delay the next poll
+MAX_DELAY = 24 * 3600
+
+def retry_after(value):
+    """ Returns the seconds requested by a Retry-After header (delta seconds
+        or HTTP date), or None if it can not be parsed.
+    """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = feedparser._parse_date(value)
+    if date:
+        return calendar.timegm(date) - time.time()
+    return None
+
+def max_age(value):
+    """ Returns the max-age of a Cache-Control header, or None.
+    """
+    directives = [d.strip().lower() for d in value.split(',')]
+    if 'no-cache' in directives or 'no-store' in directives:
+        return None
+    for directive in directives:
+        if directive.startswith('max-age='):
+            try:
+                return int(directive[len('max-age='):].strip('"'))
+            except ValueError:
+                return None
+    return None
+
+def poll_delay(feed, refresh):
+    """ Returns the seconds to wait before polling a feed again: refresh,
+        extended up to MAX_DELAY if the server asked for a longer wait
+        with Cache-Control: max-age or Retry-After.
+            feed    -- result of feedparser.parse
+            refresh -- configured interval in seconds
+    """
+    headers = feed.get('headers', {})
+    delay = refresh
+    for (header, parse) in (('retry-after', retry_after), ('cache-control', max_age)):
+        if header in headers:
+            requested = parse(headers[header])
+            if requested is not None and requested > delay:
+                delay = min(requested, MAX_DELAY)
+    return delay
+
+def entry_key(item):
+    """ Returns the key identifying a feed entry: a hash of its id (guid),
+        link or title, the first one available.
+    """
+    for field in ('id', 'link', 'title'):
+        if item.get(field):
+            return title_key(item[field], field)
+    return None
+
+def title_key(value, field = 'title'):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return hashlib.sha1('%s:%s' % (field, value)).hexdigest()
+
+
+class feedstore(object):
+    """ Keeps the keys of the entries already posted for each feed (at most
+        max_items per feed, the least recently seen are forgotten first) and
+        the validators of the last response. Entries are kept in memory and
+        written to the bot store, if there is one, once per poll.
+    """
+
+    def __init__(self, store, max_items = 1000):
+        self.store = store
+        self.max_items = max_items
+        self.seen = {}
+        self.validators = {}
+        if self.store is None:
+            logging.warning("rssbot: no storage, posted entries will be forgotten on restart")
+        else:
+            self.createTable()
+
+    def createTable(self):
+        db = self.store.getDb()
+        if not len(db.execute("pragma table_info('rss_seen')").fetchall()) > 0:
+            db.execute("""CREATE TABLE rss_seen (
+                       feed VARCHAR(256), key CHAR(40), seen REAL)""")
+        if not len(db.execute("pragma table_info('rss_feed')").fetchall()) > 0:
+            db.execute("""CREATE TABLE rss_feed (
+                       feed VARCHAR(256) PRIMARY KEY, etag VARCHAR(256), modified INTEGER)""")
+        db.close()
+        self.store.ensure_unique_index('rss_seen', 'idx_rss_seen_feed_key', ('feed', 'key'))
+
+    def load(self, feed, legacy = None):
+        """ Load the entries and validators of a feed.
+                legacy -- callable returning (titles, validators) from an old
+                          cache, used if the feed is not in the store yet
+        """
+        self.seen[feed] = OrderedDict()
+        self.validators[feed] = {}
+        if self.store is None:
+            return
+        with self.store.context_cursor() as cur:
+            cur.execute('SELECT etag, modified FROM rss_feed WHERE feed=?', (feed, ))
+            row = cur.fetchone()
+            if row is not None:
+                self.validators[feed] = {'etag': row[0], 'modified': row[1] and time.gmtime(row[1])}
+                cur.execute('SELECT key, seen FROM rss_seen WHERE feed=? ORDER BY seen DESC LIMIT ?', (feed, self.max_items))
+                for (key, seen) in reversed(cur.fetchall()):
+                    self.seen[feed][key] = seen
+                return
+        if legacy is not None:
+            (titles, validators) = legacy()
+            if titles or validators:
+                logging.info("rssbot: importing %d entries of %s from the old cache" % (len(titles), feed))
+                self.save(feed, [title_key(title) for title in titles[-self.max_items:]], validators)
+
+    def posted(self, feed, item):
+        """ True if the entry of the feed was already posted.
+        """
+        seen = self.seen[feed]
+        return entry_key(item) in seen or (item.get('title') and title_key(item['title']) in seen)
+
+    def save(self, feed, keys, validators):
+        """ Remember the entries of a poll (new or still in the feed) and the
+            validators of the response, forgetting the oldest entries beyond
+            max_items. Written in a single transaction.
+        """
+        seen = self.seen[feed]
+        now = time.time()
+        for key in keys:
+            seen.pop(key, None)
+            seen[key] = now
+        forgotten = []
+        while len(seen) > self.max_items:
+            forgotten.append(seen.popitem(last = False)[0])
+        self.validators[feed] = validators
+        if self.store is None:
+            return
+        modified = validators.get('modified')
+        with self.store.context_cursor() as cur:
+            cur.execute("""INSERT INTO rss_feed(feed, etag, modified) VALUES(?,?,?)
+                           ON CONFLICT(feed) DO UPDATE SET etag=excluded.etag, modified=excluded.modified""",
+                        (feed, validators.get('etag'), modified and calendar.timegm(modified)))
+            cur.executemany("""INSERT INTO rss_seen(feed, key, seen) VALUES(?,?,?)
+                               ON CONFLICT(feed, key) DO UPDATE SET seen=excluded.seen""",
+                            [(feed, key, now) for key in keys])
+            cur.executemany('DELETE FROM rss_seen WHERE feed=? AND key=?', [(feed, key) for key in forgotten])
+
+
 class rssbot(object):
+    """ Posts the new items of rss feeds to mucs.
+        Feeds are polled by a shared scheduler: due feeds are handed to a pool
+        of workers threads, with at most per_host fetches to the same host at
+        the same time. The first poll of each feed is delayed by a random
+        time of up to spread seconds (or its refresh if shorter).
+        The entries already posted are remembered in the bot store, at most
+        max per feed (see feedstore). Feeds are read as they are downloaded
+        and, as they list the newest entries first, the rest of a feed is
+        skipped after the first entry already posted (set stop to false
+        for feeds listing the oldest entries first).
+
+        Configuration example:
+            <config>
+                <fetch workers="4" per_host="2" spread="60" />
+                <seen max="1000" stop="true" />
+                <feed url="http://example.com/rss" refresh="10">
+                    <muc room="room@conference.example.com" />
+                </feed>
+            </config>
+    """
+
     def __init__(self, bot, config):
         self.bot = bot
         self.config = config
         #self.bot.addIMCommand('xep', self.handle_xep)
         #self.bot.addMUCCommand('xep', self.handle_xep)
         #self.bot.addHelp('xep', 'Xep Command', "Returns details of the specified XEP.", 'xep [number]')
-        self.rssCache = {}
+        self.poll_seconds = self.bot.metrics.histogram('sleekbot_feed_poll_seconds', 'Time spent polling a feed', ('feed', ))
         feeds = self.config.findall('feed')
-        self.threads = {}
+        fetch = self.config.find('fetch')
+        fetch = {} if fetch is None else fetch.attrib
+        self.per_host = int(fetch.get('per_host', 2))
+        seen = self.config.find('seen')
+        seen = {} if seen is None else seen.attrib
+        self.rssCache = feedstore(getattr(self.bot, 'store', None), int(seen.get('max', 1000)))
+        self.stop_at_seen = seen.get('stop', 'true').lower() == 'true'
+        spread = float(fetch.get('spread', 60))
         self.shuttingDown = False
-        if feeds:
-            for feed in feeds:
-                logging.info("rssbot.py script starting with feed %s." % feed.attrib['url'])
-                roomsXml = feed.findall('muc')
-                if not roomsXml:
-                    continue
-                rooms = []
-                for roomXml in roomsXml:
-                    rooms.append(roomXml.attrib['room'])
-                logging.info("Creating new thread to manage feed.")
-                self.threads[feed.attrib['url']] = thread.start_new(self.loop,(feed.attrib['url'], feed.attrib['refresh'], rooms))
+        self.scheduler = CommandScheduler(int(fetch.get('workers', 4)), 2 * len(feeds) + 1, 0)
+        self.tasks = TaskLoop(self.scheduler)
+        for feed in feeds:
+            logging.info("rssbot.py script starting with feed %s." % feed.attrib['url'])
+            roomsXml = feed.findall('muc')
+            if not roomsXml:
+                continue
+            rooms = []
+            for roomXml in roomsXml:
+                rooms.append(roomXml.attrib['room'])
+            url = feed.attrib['url']
+            refresh = float(feed.attrib['refresh'])*60
+            self.rssCache.load(url, lambda url=url: self.loadCache(url))
+            self.schedule(url, refresh, rooms, random.uniform(0, min(spread, refresh)))
 
     def shutDown(self):
         self.shuttingDown = True
         logging.info("Shutting down RSSBot plugin")
-        #for feed in self.threads.keys():
-        #    logging.info("rssbot.py killing thread for feed %s." % feed)
-        #    self.threads[feed].exit()
+        self.tasks.stop()
+        self.scheduler.stop()
 
-    def loop(self, feedUrl, refresh, rooms):
-        """ The main thread loop that polls an rss feed with a specified frequency
+    def schedule(self, feedUrl, refresh, rooms, delay):
+        """ Schedule the next poll of a feed.
         """
-        self.loadCache(feedUrl)
-        while not self.shuttingDown:
-            #print "looping on feed %s" % feedUrl
+        self.tasks.call_later(delay, self.poll, feedUrl, refresh, rooms,
+                              name = 'feed:%s' % urlparse.urlparse(feedUrl)[1], max_concurrency = self.per_host)
+
+    def poll(self, feedUrl, refresh, rooms):
+        """ Poll an rss feed, post its new items and schedule the next poll.
+        """
+        delay = refresh
+        try:
             if self.bot['xep_0045']:
-                feed = feedparser.parse(feedUrl)
-                for item in feed['entries']:
-                    if feedUrl not in self.rssCache.keys():
-                        self.rssCache[feedUrl] = []
-                    if item['title'] in self.rssCache[feedUrl]:
-                        continue
-                    #print u"found new item %s" % item['title']
-                    for muc in rooms:
-                        if muc in self.bot['xep_0045'].getJoinedRooms():
-                            #print u"sending to room %s" %muc
-                            self.sendItem(item, muc, feed['channel']['title'])
-                    self.rssCache[feedUrl].append(item['title'])
-                    #print u"remembering new item %s" % item['title']
-                    logging.debug("Saving updated feed cache for %s" % feedUrl)
-                    self.saveCache(feedUrl)
-            time.sleep(float(refresh)*60)
+                with self.poll_seconds.time((feedUrl, )):
+                    delay = self.update(feedUrl, refresh, rooms)
+        finally:
+            if not self.shuttingDown:
+                self.schedule(feedUrl, refresh, rooms, delay)
+
+    def update(self, feedUrl, refresh, rooms):
+        """ Fetch an rss feed and post its new items.
+            Returns the seconds to wait before polling it again.
+        """
+        validators = self.rssCache.validators[feedUrl]
+        entries = feedparser.iterparse(feedUrl, etag=validators.get('etag'), modified=validators.get('modified'))
+        feed = entries.result
+        delay = poll_delay(feed, refresh)
+        if feed.get('status') == 304:
+            logging.debug("Feed %s not modified" % feedUrl)
+            entries.close()
+            return delay
+        received = {'etag': feed.get('etag'), 'modified': feed.get('modified')}
+        changed = feed.get('status', 500) < 400 and received != validators
+        keys = []
+        try:
+            for item in entries:
+                key = entry_key(item)
+                if key is None:
+                    continue
+                keys.append(key)
+                if self.rssCache.posted(feedUrl, item):
+                    if self.stop_at_seen:
+                        break
+                    continue
+                #print u"found new item %s" % item['title']
+                for muc in rooms:
+                    if muc in self.bot['xep_0045'].getJoinedRooms():
+                        #print u"sending to room %s" %muc
+                        self.sendItem(item, muc, feed['channel'].get('title', feedUrl))
+                changed = True
+        finally:
+            entries.close()
+        if changed:
+            logging.debug("Saving updated feed cache for %s" % feedUrl)
+            self.rssCache.save(feedUrl, keys, received if feed.get('status', 500) < 400 else validators)
+        return delay
 
     def sendItem(self, item, muc, feedName):
         """ Sends a summary of an rss item to a specified muc.
@@ -81,7 +295,7 @@ class rssbot(object):
         else:
             content = ''
         text = html2text("Update from feed %s\n%s\n%s" % (feedName, self.bot.xmlesc(item['title']), content))
-        self.bot.sendMessage(muc, text, mtype='groupchat')
+        self.bot.send_message(muc, text, mtype='groupchat')
 
     def cacheFilename(self, feedUrl):
         """ Returns the filename used to store the cache for a feedUrl
@@ -90,23 +304,20 @@ class rssbot(object):
         return "rsscache-%s.dat" % rep.sub('', feedUrl)
 
     def loadCache(self, feed):
-        """ Loads the cache of entries
+        """ Returns the titles and validators of the old pickled cache of a feed
+            (see feedstore.load)
         """
         try:
             f = open(self.cacheFilename(feed), 'rb')
-            self.rssCache[feed] = pickle.load(f)
-        except:
-            print "Error loading rss data %s" % self.cacheFilename(feed)
-            return
-        f.close()
-
-    def saveCache(self, feed):
-        """ Saves the cache of entries
-        """
-        try:
-            f = open(self.cacheFilename(feed), 'wb')
         except IOError:
-            print "Error saving rss data %s" % cacheFilename(food)
-            return
-        pickle.dump(self.rssCache[feed], f)
-        f.close()
+            return ([], {})
+        try:
+            cache = pickle.load(f)
+        except Exception, e:
+            logging.warning("Error loading rss data %s: %s" % (self.cacheFilename(feed), e))
+            return ([], {})
+        finally:
+            f.close()
+        if isinstance(cache, dict):
+            return (cache['titles'], cache['validators'])
+        return (cache, {})
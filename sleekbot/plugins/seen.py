@@ -9,6 +9,7 @@ import logging
 
 from sleekbot.commandbot import botcmd
 from sleekbot.plugbot import BotPlugin
+from sleekbot.store import WriteBehind
 
 class seenevent(object):
     """ Represent the last know activity of a user.
@@ -49,46 +50,35 @@ class jidstore(object):
                        id INTEGER PRIMARY KEY AUTOINCREMENT, muc VARCHAR(256),
                        nick VARCHAR(256), jid VARCHAR(256), eventTime DATETIME)""")
         db.close()
+        self.store.ensure_unique_index('whowas', 'idx_whowas_nick_muc', ('nick', 'muc'))
 
     def update(self, event):
-        db = self.store.getDb()
-        cur = db.cursor()
         logging.debug("Updating whowas")
-        cur.execute('SELECT * FROM whowas WHERE nick=? AND muc=?', (event.nick, event.muc))
-        if (len(cur.fetchall()) > 0):
-            cur.execute('UPDATE whowas SET jid=?, eventTime=?', (event.jid, event.eventTime))
-            logging.debug("Updated existing whowas")
-        else:
-            cur.execute('INSERT INTO whowas(nick, muc, jid, eventTime) VALUES(?,?,?,?)',(event.nick, event.muc, event.jid, event.eventTime))
-            logging.debug("Added new whowas")
-        db.commit()
-        db.close()
-
+        with self.store.context_cursor() as cur:
+            cur.execute("""INSERT INTO whowas(nick, muc, jid, eventTime) VALUES(?,?,?,?)
+                           ON CONFLICT(nick, muc) DO UPDATE SET jid=excluded.jid, eventTime=excluded.eventTime""",
+                        (event.nick, event.muc, event.jid, event.eventTime))
 
     def get(self, nick, muc):
-        db = self.store.getDb()
-        cur = db.cursor()
-        cur.execute('SELECT * FROM seen WHERE nick=? AND muc=?', (nick,muc))
-        results = cur.fetchall()
-        if len(results) == 0:
+        with self.store.context_cursor() as cur:
+            cur.execute('SELECT muc, nick, jid, eventTime FROM whowas WHERE nick=? AND muc=?', (nick,muc))
+            result = cur.fetchone()
+        if result is None:
             return None
-        return jidevent(results[0][1],results[0][2],results[0][3],datetime.datetime.strptime(results[0][4][0:19],"""%Y-%m-%d %H:%M:%S""" ))
-        db.close()
+        return jidevent(result[0],result[1],result[2],datetime.datetime.strptime(result[3][0:19],"""%Y-%m-%d %H:%M:%S""" ))
 
     def delete(self, nick, muc):
-        db = self.store.getDb()
-        cur = db.cursor()
-        cur.execute('DELETE FROM seen WHERE nick=? AND muc=?', (nick,muc))
-        db.commit()
-        db.close()
+        with self.store.context_cursor() as cur:
+            cur.execute('DELETE FROM whowas WHERE nick=? AND muc=?', (nick,muc))
 
 class seenstore(object):
-    def __init__(self, store):
+    def __init__(self, store, interval = 1.0, max_pending = 100):
         #self.null = None
         #self.data = {}
         #self.loaddefault()
         self.store = store
         self.createTable()
+        self.pending = WriteBehind(self.write, interval, max_pending, 'seenstore')
 
     def createTable(self):
         db = self.store.getDb()
@@ -100,44 +90,65 @@ class seenstore(object):
         #if len(db.execute("pragma table_info('seen')").fetchall()) == 6:
         #    db.execute("""ALTER TABLE seen ADD COLUMN fullJid VARCHAR(256)""")
         db.close()
+        self.store.ensure_unique_index('seen', 'idx_seen_nick', ('nick', ))
 
     def update(self, event):
-        db = self.store.getDb()
-        cur = db.cursor()
+        """ Enqueue the event. Only the last event of each nick is written.
+        """
         logging.debug("Updating seen for %s - time: %s" % (event.nick, event.eventTime))
-        cur.execute('SELECT * FROM seen WHERE nick=?', (event.nick,))
-        if (len(cur.fetchall()) > 0):
-            cur.execute('UPDATE seen SET nick=?, eventTime=?, muc=?, stanzaType=?, text=? WHERE nick=?', (event.nick, event.eventTime, event.muc, event.stanzaType, event.text, event.nick))
-            logging.debug("Updated existing seen")
-        else:
-            cur.execute('INSERT INTO seen(nick, eventTime, muc, stanzaType, text) VALUES(?,?,?,?,?)',(event.nick, event.eventTime, event.muc, event.stanzaType, event.text))
-            logging.debug("Added new seen")
-        db.commit()
-        db.close()
+        self.pending.put(event.nick, event)
+
+    def write(self, events):
+        """ Write a batch of events in a single transaction.
+        """
+        with self.store.context_cursor() as cur:
+            cur.executemany("""INSERT INTO seen(nick, eventTime, muc, stanzaType, text) VALUES(?,?,?,?,?)
+                               ON CONFLICT(nick) DO UPDATE SET eventTime=excluded.eventTime, muc=excluded.muc,
+                               stanzaType=excluded.stanzaType, text=excluded.text""",
+                            [(event.nick, event.eventTime, event.muc, event.stanzaType, event.text) for event in events])
+        logging.debug("Wrote %d seen events" % len(events))
 
     def get(self, nick):
-        db = self.store.getDb()
-        cur = db.cursor()
-        cur.execute('SELECT * FROM seen WHERE nick=?', (nick,))
-        results = cur.fetchall()
-        if len(results) == 0:
+        event = self.pending.get(nick)
+        if event is not None:
+            return seenevent(event.nick, datetime.datetime.strptime(event.eventTime[0:19],"""%Y-%m-%d %H:%M:%S""" ), event.muc, event.stanzaType, event.text)
+        with self.store.context_cursor() as cur:
+            cur.execute('SELECT nick, eventTime, muc, stanzaType, text FROM seen WHERE nick=?', (nick,))
+            result = cur.fetchone()
+        if result is None:
             return None
-        return seenevent(results[0][1],datetime.datetime.strptime(results[0][2][0:19],"""%Y-%m-%d %H:%M:%S""" ),results[0][3],results[0][4],results[0][5])
-        db.close()
+        return seenevent(result[0],datetime.datetime.strptime(result[1][0:19],"""%Y-%m-%d %H:%M:%S""" ),result[2],result[3],result[4])
 
     def delete(self, nick):
-        db = self.store.getDb()
-        cur = db.cursor()
-        cur.execute('DELETE FROM seen WHERE nick=?', (nick,))
-        db.commit()
-        db.close()
+        self.pending.discard(nick)
+        with self.store.context_cursor() as cur:
+            cur.execute('DELETE FROM seen WHERE nick=?', (nick,))
+
+    def close(self):
+        """ Write pending events.
+        """
+        self.pending.close()
 
 class seen(BotPlugin):
-    """A plugin to keep track of user presence."""
+    """A plugin to keep track of user presence.
+
+        Configuration example. Updates are written every interval
+        milliseconds or as soon as updates of events distinct nicks are
+        waiting (updates of the same nick are coalesced), whichever comes first.
+        <plugin name="seen">
+            <config>
+                <writebehind interval="1000" events="100" />
+            </config>
+        </plugin>
+    """
 
     def on_register(self):
         #BotPlugin.__init__(self, bot, config)
-        self.seenstore = seenstore(self.bot.store)
+        interval, events = 1000, 100
+        if self.config is not None and self.config.find('writebehind') is not None:
+            interval = int(self.config.find('writebehind').attrib.get('interval', interval))
+            events = int(self.config.find('writebehind').attrib.get('events', events))
+        self.seenstore = seenstore(self.bot.store, interval / 1000.0, events)
         #self.bot.addIMCommand('whowas', self.handle_whowas_request)
         #self.bot.addMUCCommand('whowas', self.handle_whowas_request)
         #self.bot.addHelp('whowas', 'Jid of member', "See the last jid of a member", 'whowas')
@@ -145,6 +156,11 @@ class seen(BotPlugin):
         self.bot.add_event_handler("groupchat_presence", self.handle_groupchat_presence, threaded=True)
         self.bot.add_event_handler("groupchat_message", self.handle_groupchat_message, threaded=True)
 
+    def on_unregister(self):
+        self.bot.del_event_handler("groupchat_presence", self.handle_groupchat_presence)
+        self.bot.del_event_handler("groupchat_message", self.handle_groupchat_message)
+        self.seenstore.close()
+
     def handle_groupchat_presence(self, presence):
         """ Keep track of the presences in mucs.
         """
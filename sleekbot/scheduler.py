@@ -0,0 +1,310 @@
+"""
+    This file is part of SleekBot. http://github.com/hgrecco/SleekBot
+    See the README file for more information.
+"""
+
+__author__ = 'Hernan E. Grecco <hernan.grecco@gmail.com>'
+__license__ = 'MIT License/X11 license'
+
+import logging
+import threading
+import time
+import Queue
+import itertools
+
+from collections import defaultdict, deque
+from heapq import heappush, heappop
+
+class Job(object):
+    """ A call waiting to be executed (or being executed) by a CommandScheduler.
+    """
+
+    QUEUED, RUNNING, DONE, EXPIRED = range(4)
+
+    def __init__(self, name, f, args, on_done, on_timeout, deadline):
+        self.name = name
+        self.f = f
+        self.args = args
+        self.on_done = on_done
+        self.on_timeout = on_timeout
+        self.deadline = deadline
+        self.state = Job.QUEUED
+        self.lock = threading.Lock()
+
+    def finish(self, state):
+        """ Moves the job to a final state. Returns False if it was already in one.
+        """
+        with self.lock:
+            if self.state in (Job.DONE, Job.EXPIRED):
+                return False
+            self.state = state
+            return True
+
+
+class CommandScheduler(object):
+    """ Runs calls on a bounded pool of worker threads.
+        Calls are grouped by name (the command name) and each name can have
+        a maximum number of calls running at the same time. Calls over that
+        limit wait in a per name queue without holding a worker.
+        When too many calls are waiting, submit blocks for a while and then
+        rejects the call (backpressure).
+    """
+
+    def __init__(self, workers = 4, queue_size = 100, wait = 5.0):
+        """ Initialize the scheduler and start the workers
+                workers    -- number of worker threads (default 4)
+                queue_size -- maximum number of calls waiting (default 100)
+                wait       -- seconds submit blocks when the queue is full (default 5)
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self.wait = wait
+        self.__ready = Queue.Queue()
+        self.__lock = threading.Condition(threading.Lock())
+        self.__pending = 0
+        self.__running = defaultdict(int)
+        self.__waiting = defaultdict(deque)
+        self.__deadlines = []
+        self.__deadline_cond = threading.Condition(threading.Lock())
+        self.__stopped = False
+        self.__threads = []
+        for n in range(workers):
+            self.__start_thread(self.__work, 'CommandScheduler-%d' % n)
+        self.__start_thread(self.__watch, 'CommandScheduler-timeouts')
+
+    def submit(self, name, f, args, on_done, max_concurrency = None, timeout = None, on_timeout = None):
+        """ Schedule a call f(*args)
+                name            -- name used to group calls (command name)
+                f               -- callable
+                args            -- tuple of arguments
+                on_done         -- callable receiving the result of f
+                max_concurrency -- maximum calls of this name running at the same time
+                                   (default None, no limit)
+                timeout         -- seconds after which on_timeout is called and the
+                                   result discarded (default None, no timeout)
+                on_timeout      -- callable without arguments (default None)
+
+            Returns False if the call was rejected because the queue is full.
+        """
+        deadline = timeout and time.time() + timeout
+        job = Job(name, f, args, on_done, on_timeout, deadline)
+        with self.__lock:
+            limit = time.time() + self.wait
+            while self.__pending >= self.queue_size:
+                remaining = limit - time.time()
+                if remaining <= 0 or self.__stopped:
+                    logging.warning("CommandScheduler: queue full, %s rejected" % name)
+                    return False
+                self.__lock.wait(remaining)
+            self.__pending += 1
+            if max_concurrency and self.__running[name] >= max_concurrency:
+                self.__waiting[name].append(job)
+            else:
+                self.__running[name] += 1
+                self.__ready.put(job)
+        if deadline:
+            with self.__deadline_cond:
+                heappush(self.__deadlines, (deadline, id(job), job))
+                self.__deadline_cond.notify()
+        return True
+
+    def stop(self):
+        """ Stop the workers once the calls already running finish.
+            Waiting calls are discarded.
+        """
+        with self.__lock:
+            self.__stopped = True
+            self.__lock.notify_all()
+        for thread in self.__threads:
+            self.__ready.put(None)
+        with self.__deadline_cond:
+            self.__deadline_cond.notify()
+
+    def pending(self):
+        """ Returns the number of calls waiting or running.
+        """
+        return self.__pending
+
+    def __start_thread(self, target, name):
+        thread = threading.Thread(target = target, name = name)
+        thread.daemon = True
+        thread.start()
+        self.__threads.append(thread)
+
+    def __work(self):
+        while True:
+            job = self.__ready.get()
+            if job is None:
+                return
+            try:
+                with job.lock:
+                    run = job.state == Job.QUEUED
+                    if run:
+                        job.state = Job.RUNNING
+                if run:
+                    try:
+                        result = job.f(*job.args)
+                    except Exception:
+                        job.finish(Job.DONE)
+                        logging.exception("CommandScheduler: error while running %s" % job.name)
+                    else:
+                        if job.finish(Job.DONE):
+                            job.on_done(result)
+            finally:
+                self.__release(job)
+
+    def __release(self, job):
+        with self.__lock:
+            self.__pending -= 1
+            self.__running[job.name] -= 1
+            if self.__waiting[job.name] and not self.__stopped:
+                self.__running[job.name] += 1
+                self.__ready.put(self.__waiting[job.name].popleft())
+            elif not self.__waiting[job.name]:
+                del self.__waiting[job.name]
+                if not self.__running[job.name]:
+                    del self.__running[job.name]
+            self.__lock.notify()
+
+    def __watch(self):
+        """ Expire the jobs that exceeded their deadline.
+        """
+        while True:
+            with self.__deadline_cond:
+                while not self.__stopped:
+                    if not self.__deadlines:
+                        self.__deadline_cond.wait()
+                        continue
+                    remaining = self.__deadlines[0][0] - time.time()
+                    if remaining <= 0:
+                        break
+                    self.__deadline_cond.wait(remaining)
+                if self.__stopped:
+                    return
+                job = heappop(self.__deadlines)[2]
+            if job.finish(Job.EXPIRED):
+                logging.warning("CommandScheduler: %s timed out" % job.name)
+                if job.on_timeout is not None:
+                    try:
+                        job.on_timeout()
+                    except Exception:
+                        logging.exception("CommandScheduler: error in timeout handler of %s" % job.name)
+
+
+class Task(object):
+    """ A callback scheduled in a TaskLoop. Call cancel() to unschedule it.
+    """
+
+    def __init__(self, loop, f, args, interval, name, max_concurrency = 1):
+        self.loop = loop
+        self.f = f
+        self.args = args
+        self.interval = interval
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        """ Execute the callback and reschedule it if it is periodic.
+        """
+        try:
+            if not self.cancelled:
+                self.f(*self.args)
+        finally:
+            if self.interval is not None and not self.cancelled:
+                self.loop.schedule(self, self.interval)
+
+
+class TaskLoop(object):
+    """ The shared loop of timed and periodic callbacks of the bot.
+        A single thread keeps the callbacks ordered by due time and hands the
+        due ones to a CommandScheduler, so plugins do not need a thread of
+        their own that sleeps between runs.
+        A periodic callback is rescheduled when its run finishes, so runs of
+        the same task never overlap.
+    """
+
+    def __init__(self, scheduler):
+        """ Initialize the loop and start its thread
+                scheduler -- CommandScheduler used to execute the callbacks
+        """
+        self.scheduler = scheduler
+        self.__tasks = []
+        self.__count = itertools.count()
+        self.__cond = threading.Condition(threading.Lock())
+        self.__stopped = False
+        thread = threading.Thread(target = self.__loop, name = 'TaskLoop')
+        thread.daemon = True
+        thread.start()
+
+    def call_later(self, delay, f, *args, **kwargs):
+        """ Execute f(*args) once after delay seconds. Returns a Task.
+                name            -- keyword argument, name grouping the runs in the
+                                   scheduler (default 'task:' + name of f)
+                max_concurrency -- keyword argument, maximum runs of tasks of the
+                                   same name at the same time (default 1)
+        """
+        task = Task(self, f, args, None, kwargs.get('name') or self.__name(f), kwargs.get('max_concurrency', 1))
+        return self.schedule(task, delay)
+
+    def call_every(self, interval, f, *args, **kwargs):
+        """ Execute f(*args) every interval seconds. Returns a Task.
+                delay -- keyword argument, seconds before the first run
+                         (default interval)
+                name, max_concurrency -- keyword arguments as in call_later
+        """
+        task = Task(self, f, args, interval, kwargs.get('name') or self.__name(f), kwargs.get('max_concurrency', 1))
+        return self.schedule(task, kwargs.get('delay', interval))
+
+    def run_in_executor(self, f, *args, **kwargs):
+        """ Execute f(*args) in the scheduler as soon as possible.
+                callback -- keyword argument, callable receiving the result
+                            (default None)
+
+            Returns False if the scheduler rejected the call.
+        """
+        callback = kwargs.get('callback') or (lambda result: None)
+        return self.scheduler.submit(self.__name(f), f, args, callback)
+
+    def schedule(self, task, delay):
+        """ (Re)schedule a task to run after delay seconds. Returns the task.
+        """
+        with self.__cond:
+            heappush(self.__tasks, (time.time() + delay, next(self.__count), task))
+            self.__cond.notify()
+        return task
+
+    def stop(self):
+        """ Stop the loop. Scheduled callbacks are discarded.
+        """
+        with self.__cond:
+            self.__stopped = True
+            self.__tasks = []
+            self.__cond.notify()
+
+    def __name(self, f):
+        return 'task:%s' % getattr(f, '__name__', f)
+
+    def __loop(self):
+        while True:
+            with self.__cond:
+                while not self.__stopped:
+                    if not self.__tasks:
+                        self.__cond.wait()
+                        continue
+                    remaining = self.__tasks[0][0] - time.time()
+                    if remaining <= 0:
+                        break
+                    self.__cond.wait(remaining)
+                if self.__stopped:
+                    return
+                task = heappop(self.__tasks)[2]
+            if task.cancelled:
+                continue
+            if not self.scheduler.submit(task.name, task.run, (), lambda result: None, task.max_concurrency):
+                logging.warning("TaskLoop: %s could not be scheduled" % task.name)
+                if task.interval is not None:
+                    self.schedule(task, task.interval)
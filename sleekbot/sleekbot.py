@@ -23,7 +23,8 @@ import time
 import sys
 import logging
 
-from store import store
+from store import store, tuning_from_xml
+from outbox import Outbox
 from optparse import OptionParser
 from xml.etree import ElementTree as ET
 
@@ -33,6 +34,12 @@ from sleekxmpp.xmlstream.stanzabase import JID
 from commandbot import  CommandBot
 from plugbot import PlugBot
 
+def xml_text(node):
+    """ Returns an element as text to compare configurations (None if missing)
+    """
+    if node is not None:
+        return ET.tostring(node).strip()
+
 class SleekBot(sleekxmpp.ClientXMPP, CommandBot,  PlugBot):
     """ SleekBot is a pluggable Jabber/XMPP bot based on SleekXMPP
 
@@ -51,9 +58,15 @@ class SleekBot(sleekxmpp.ClientXMPP, CommandBot,  PlugBot):
         sleekxmpp.ClientXMPP.__init__(self, auth.attrib['jid'], auth.attrib['pass'], auth.get('ssl', True), plugin_config)
         storageXml = self.botconfig.find('storage')
         if storageXml is not None:
-            self.store = store(storageXml.attrib['file'])
+            self.store = store(storageXml.attrib['file'], int(storageXml.attrib.get('pool', 5)),
+                               tuning_from_xml(storageXml.find('tuning')))
         else:
             logging.warning("No storage element found in config file - proceeding with no persistent storage, plugin behaviour may be undefined.")
+        outbox = self.botconfig.find('outbox')
+        outbox = {} if outbox is None else outbox.attrib
+        self.outbox = Outbox(self.sendMessage, float(outbox.get('rate', 2)), int(outbox.get('burst', 5)),
+                             float(outbox.get('window', 0.2)), int(outbox.get('max_length', 3000)),
+                             int(outbox.get('short_length', 400)), int(outbox.get('queue', 100)))
         self.rooms = {}
         self.add_event_handler("session_start", self.handle_session_start, threaded=True)
         self.register_xmpp_plugins()
@@ -134,23 +147,31 @@ class SleekBot(sleekxmpp.ClientXMPP, CommandBot,  PlugBot):
 
     def rehash(self):
         """ Re-reads the config file, making appropriate runtime changes.
-            Causes all plugins to be reloaded (or unloaded).
+            Only the plugins whose <plugin> element or module source changed
+            are reloaded (or unloaded). Messages are paused only while they
+            are swapped. The acl is rebuilt if its configuration changed and
+            otherwise reloaded from its storage (see ACLdb.refresh).
             The XMPP stream and MUC rooms will not be disconnected.
         """
         logging.info("Rehashing started")
-        modules = self.cmd_plugins.get_modules()
-        CommandBot.pause(self)
-        PlugBot.stop(self)
-
         logging.info("Reloading config file")
+        oldconfig = self.botconfig
         self.botconfig = self.load_config(self.config_file)
-        for module in modules:
-            reload(module)
-        CommandBot.reset(self)
+        changes = PlugBot.plugin_changes(self)
+        reset_acl = [xml_text(oldconfig.find(tag)) for tag in ('acl', 'require-membership')] != \
+                    [xml_text(self.botconfig.find(tag)) for tag in ('acl', 'require-membership')]
 
-        PlugBot.start(self)
-        CommandBot.resume(self)
+        CommandBot.pause(self)
+        try:
+            PlugBot.apply_plugin_changes(self, changes)
+            if reset_acl:
+                CommandBot.reset_acl(self)
+            elif hasattr(self.acl, 'refresh'):
+                self.acl.refresh()
+        finally:
+            CommandBot.resume(self)
         self.join_rooms()
+        logging.info("Rehashing finished")
 
     def join_rooms(self):
         """ Join to MUC rooms
@@ -163,6 +184,7 @@ class SleekBot(sleekxmpp.ClientXMPP, CommandBot,  PlugBot):
         for room in set(self.rooms.keys()).difference(rooms.keys()):
             logging.info("Parting room %s." % room)
             self.plugin['xep_0045'].leaveMUC(room, self.rooms[room])
+            self.forget_room(room)
             del self.rooms[room]
         for room in set(rooms.keys()).difference(self.rooms.keys()):
             self.rooms[room] = rooms[room]
@@ -174,6 +196,7 @@ class SleekBot(sleekxmpp.ClientXMPP, CommandBot,  PlugBot):
         """
         PlugBot.stop(self)
         CommandBot.stop(self)
+        self.outbox.stop()
         self.rooms = {}
         logging.info("Disconnecting bot")
         self.disconnect()
@@ -186,9 +209,11 @@ class SleekBot(sleekxmpp.ClientXMPP, CommandBot,  PlugBot):
         logging.info("Restarting bot")
         self.die()
 
-    #TODO: temporary until SleekXMPP is PEP8 compliant
-    def send_message(self,  *args,  **kwargs):
-        self.sendMessage(*args,  **kwargs)
+    def send_message(self, mto, mbody, **kwargs):
+        """ Send a message through the outbox (see Outbox).
+            Keyword arguments as in sendMessage.
+        """
+        self.outbox.put(mto, mbody, **kwargs)
 
 if __name__ == '__main__':
     #parse command line arguements
@@ -18,9 +18,77 @@
 """
 
 import sqlite3
+import threading
+import logging
+import time
+import thread
+import re
+
+import metrics
+
+QUERIES = metrics.registry.counter('sleekbot_db_queries_total', 'Queries executed', ('table', ))
+QUERY_SECONDS = metrics.registry.histogram('sleekbot_db_query_seconds', 'Time spent executing queries', ('table', ))
+WRITES_DROPPED = metrics.registry.counter('sleekbot_writebehind_dropped_total', 'Values dropped after failing to be written', ('buffer', ))
+TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE|INDEX\s+\w+\s+ON)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)', re.I)
+
+def query_table(sql):
+    """ Returns the first table named in a sql statement (or '' if none).
+    """
+    match = TABLE.search(sql)
+    return match.group(1).lower() if match else ''
+
+#: Named sets of pragmas that can be selected with <tuning profile='...'/>
+PROFILES = {
+    'default': {},
+    'concurrent': {'journal_mode': 'WAL', 'synchronous': 'NORMAL',
+                   'busy_timeout': 5000, 'temp_store': 'MEMORY'},
+    'safe': {'journal_mode': 'WAL', 'synchronous': 'FULL', 'busy_timeout': 5000},
+}
+
+#: Pragmas accepted in a tuning profile and the type of their value
+PRAGMAS = {
+    'journal_mode': str,
+    'synchronous': str,
+    'cache_size': int,
+    'mmap_size': int,
+    'busy_timeout': int,
+    'temp_store': str,
+}
+
+def tuning_from_xml(xmlnode):
+    """ Returns a dict of pragmas from a <tuning> element. For example:
+            <tuning profile='concurrent' cache_size='-8000' />
+        The attributes override the values of the profile (default 'default').
+
+        Raises:
+            ValueError if the profile, a pragma or a value is not valid.
+    """
+    if xmlnode is None:
+        return {}
+    profile = xmlnode.attrib.get('profile', 'default')
+    if not profile in PROFILES:
+        raise ValueError('Unknown storage tuning profile %s' % profile)
+    pragmas = dict(PROFILES[profile])
+    for name, value in xmlnode.attrib.items():
+        if name != 'profile':
+            pragmas[name] = value
+    for name, value in pragmas.items():
+        if not name in PRAGMAS:
+            raise ValueError('Unknown storage pragma %s' % name)
+        value = PRAGMAS[name](value)
+        if isinstance(value, str) and not re.match(r'^\w+$', value):
+            raise ValueError('Invalid value %s for storage pragma %s' % (value, name))
+        pragmas[name] = value
+    return pragmas
 
 class CMCursor(object):
-    """ Context manager for cursor. On exit commits and close the connection."""
+    """ Context manager for cursor. On exit commits (or rolls back on error)
+        and releases the connection.
+        Nested blocks in the same thread share the connection and its
+        transaction, which is only committed or rolled back by the outermost
+        one (sqlite3 commits before a SAVEPOINT in python 2, so nested
+        blocks can not be rolled back on their own).
+    """
 
     def __init__(self, call_to_connect):
         self.__connect = call_to_connect
@@ -30,27 +98,366 @@ class CMCursor(object):
         return self.__con.cursor()
 
     def __exit__(self, type, value, tb):
-        if tb is None:
-            self.__con.commit()
-            self.__con.close()
-            self.__con = None
-        else:
-            self.__con.rollback()
-            self.__con.close()
-            self.__con = None
+        con, self.__con = self.__con, None
+        try:
+            if getattr(con, 'nested', False):
+                return
+            if tb is None:
+                con.commit()
+            else:
+                con.rollback()
+        finally:
+            con.close()
+
+
+class TimedCursor(object):
+    """ Proxy to a sqlite3 cursor counting the queries and measuring their
+        time per table (see metrics).
+    """
+
+    def __init__(self, cursor):
+        self.__cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.__cursor, name)
+
+    def __iter__(self):
+        return iter(self.__cursor)
+
+    def __timed(self, method, sql, *args):
+        labels = (query_table(sql), )
+        QUERIES.inc(labels)
+        with QUERY_SECONDS.time(labels):
+            method(sql, *args)
+        return self
+
+    def execute(self, sql, *args):
+        return self.__timed(self.__cursor.execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.__timed(self.__cursor.executemany, sql, *args)
+
+
+class PooledConnection(object):
+    """ Proxy to a connection borrowed from a ConnectionPool.
+        Behaves as a sqlite3 connection but close() gives it back to the pool.
+        nested is True if the thread already held the connection.
+        Cursors count and time their queries while metrics are enabled.
+    """
+
+    def __init__(self, pool, con, owner, nested = False):
+        self.__pool = pool
+        self.__con = con
+        self.__owner = owner
+        self.nested = nested
+
+    def __getattr__(self, name):
+        return getattr(self.__con, name)
+
+    def cursor(self, *args):
+        cursor = self.__con.cursor(*args)
+        if metrics.registry.enabled:
+            return TimedCursor(cursor)
+        return cursor
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
+
+    def close(self):
+        if self.__con is not None:
+            con, self.__con = self.__con, None
+            self.__pool.release(con, self.__owner)
+
+    def __del__(self):
+        self.close()
+
+
+class ConnectionPool(object):
+    """ A thread-safe pool of sqlite3 connections.
+        A thread asking again for a connection while it holds one gets the same
+        connection back, so nested cursors share the connection (and transaction).
+    """
+
+    def __init__(self, connect, size = 5, timeout = 5.0, check_after = 300.0):
+        """ Initialize the pool
+                connect     -- callable returning a new sqlite3 connection
+                size        -- maximum number of pooled connections (default 5)
+                timeout     -- seconds to wait for a free connection before
+                               opening an unpooled one (default 5)
+                check_after -- idle seconds after which a connection is checked
+                               before being handed out (default 300)
+        """
+        self.__connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.check_after = check_after
+        self.__lock = threading.Condition(threading.Lock())
+        self.__idle = []
+        self.__owned = {}
+        self.__created = 0
+
+    def connection(self):
+        """ Returns a PooledConnection for the current thread.
+        """
+        owner = thread.get_ident()
+        with self.__lock:
+            if owner in self.__owned:
+                self.__owned[owner][1] += 1
+                return PooledConnection(self, self.__owned[owner][0], owner, True)
+            con = self.__take()
+            self.__owned[owner] = [con, 1]
+        return PooledConnection(self, con, owner)
+
+    def release(self, con, owner):
+        """ Give back a connection. It returns to the idle list when the owner
+            thread releases it as many times as it was acquired.
+        """
+        with self.__lock:
+            held = self.__owned.get(owner)
+            if held is not None and held[0] is con:
+                held[1] -= 1
+                if held[1] > 0:
+                    return
+                del self.__owned[owner]
+            try:
+                con.rollback()
+            except sqlite3.Error:
+                self.__discard(con)
+                return
+            if getattr(con, 'pooled', True):
+                self.__idle.append((con, time.time()))
+                self.__lock.notify()
+            else:
+                self.__discard(con)
+
+    def close(self):
+        """ Close all idle connections.
+        """
+        with self.__lock:
+            while self.__idle:
+                self.__discard(self.__idle.pop()[0])
+
+    def __take(self):
+        """ Get an idle connection, a new one or wait. Must be called holding the lock.
+        """
+        deadline = time.time() + self.timeout
+        while True:
+            while self.__idle:
+                con, since = self.__idle.pop()
+                if time.time() - since < self.check_after or self.__healthy(con):
+                    return con
+                self.__discard(con)
+            if self.__created < self.size:
+                self.__created += 1
+                try:
+                    return self.__connect()
+                except:
+                    self.__created -= 1
+                    raise
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logging.warning("ConnectionPool: no free connection after %s seconds, opening an unpooled one." % self.timeout)
+                return _Unpooled(self.__connect())
+            self.__lock.wait(remaining)
+
+    def __healthy(self, con):
+        try:
+            con.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error, e:
+            logging.warning("ConnectionPool: dropping broken connection: %s" % e)
+            return False
+
+    def __discard(self, con):
+        if getattr(con, 'pooled', True):
+            self.__created -= 1
+        try:
+            con.close()
+        except sqlite3.Error:
+            pass
+
+
+class _Unpooled(object):
+    """ Wraps a connection opened when the pool is exhausted. It is closed on release.
+    """
+    pooled = False
+
+    def __init__(self, con):
+        self.__con = con
+
+    def __getattr__(self, name):
+        return getattr(self.__con, name)
+
+
+class WriteBehind(object):
+    """ Write-behind buffer. Values are coalesced by key in memory and handed
+        to a flush callable in a single batch every interval seconds or as soon
+        as max_pending keys are waiting, whichever comes first.
+        Values waiting to be written can be read with get.
+        A batch that fails is retried with the next one; values that failed
+        max_retries times are dropped.
+    """
+
+    def __init__(self, flush, interval = 1.0, max_pending = 100, name = 'WriteBehind', max_retries = 3):
+        """ Initialize the buffer and start the flushing thread
+                flush       -- callable receiving a list of values. It should
+                               write them in a single transaction.
+                interval    -- seconds between flushes (default 1)
+                max_pending -- number of pending keys that triggers a flush (default 100)
+                name        -- used for the thread name, logging and metrics
+                max_retries -- failed flushes after which a value is dropped (default 3)
+        """
+        self.__flush = flush
+        self.interval = interval
+        self.max_pending = max_pending
+        self.name = name
+        self.max_retries = max_retries
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        self.__pending = {}
+        self.__flushing = {}
+        self.__failures = {}
+        self.__wakeup = threading.Event()
+        self.__running = True
+        self.__thread = threading.Thread(target = self.__loop, name = name)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def put(self, key, value):
+        """ Enqueue a value replacing any pending value for the same key.
+        """
+        with self.__lock:
+            self.__pending[key] = value
+            self.__failures.pop(key, None)
+            full = len(self.__pending) >= self.max_pending
+        if full:
+            self.__wakeup.set()
+
+    def get(self, key, default = None):
+        """ Returns the value pending to be written for key, or default.
+        """
+        with self.__lock:
+            if key in self.__pending:
+                return self.__pending[key]
+            return self.__flushing.get(key, default)
+
+    def discard(self, key):
+        """ Forget the value pending to be written for key.
+        """
+        with self.__lock:
+            self.__pending.pop(key, None)
+            self.__flushing.pop(key, None)
+            self.__failures.pop(key, None)
+
+    def flush(self):
+        """ Write all pending values now.
+        """
+        with self.__flush_lock:
+            with self.__lock:
+                if not self.__pending:
+                    return
+                self.__flushing, self.__pending = self.__pending, {}
+            batch = self.__flushing
+            try:
+                self.__flush(batch.values())
+            except Exception, e:
+                logging.error("%s: error while flushing %d values: %s" % (self.name, len(batch), e))
+                dropped = 0
+                with self.__lock:
+                    for key, value in batch.items():
+                        if key in self.__pending:
+                            continue
+                        failures = self.__failures.get(key, 0) + 1
+                        if failures >= self.max_retries:
+                            self.__failures.pop(key, None)
+                            dropped += 1
+                        else:
+                            self.__failures[key] = failures
+                            self.__pending[key] = value
+                if dropped:
+                    WRITES_DROPPED.inc((self.name, ), dropped)
+                    logging.error("%s: %d values dropped after %d failed writes" % (self.name, dropped, self.max_retries))
+            else:
+                with self.__lock:
+                    for key in batch:
+                        self.__failures.pop(key, None)
+            finally:
+                with self.__lock:
+                    self.__flushing = {}
+
+    def close(self):
+        """ Flush pending values and stop the flushing thread.
+        """
+        self.__running = False
+        self.__wakeup.set()
+        self.__thread.join()
+        self.flush()
+
+    def __loop(self):
+        while self.__running:
+            self.__wakeup.wait(self.interval)
+            self.__wakeup.clear()
+            self.flush()
+
 
 class store(object):
     """ Store persistent data in sqlite3.
     """
-    def __init__(self, filename):
+    def __init__(self, filename, pool_size = 5, pragmas = None):
+        """ Initialize the store
+                filename  -- sqlite3 database file
+                pool_size -- maximum number of pooled connections (default 5)
+                pragmas   -- dict of pragmas applied to every connection,
+                             see tuning_from_xml (default None)
+        """
         self.filename = filename
+        self.pragmas = pragmas or {}
+        self.pool = ConnectionPool(self.connect, pool_size)
+        if self.pragmas:
+            logging.info("Storage tuning: %s" % ', '.join('%s=%s' % item for item in sorted(self.pragmas.items())))
+
+    def connect(self):
+        """ Open a new raw DB connection and apply the pragmas. Used by the pool.
+        """
+        con = sqlite3.connect(self.filename, check_same_thread = False)
+        for name, value in self.pragmas.items():
+            con.execute('PRAGMA %s = %s' % (name, value)).fetchall()
+        return con
 
     def getDb(self):
-        """ Return a new DB connection
+        """ Return a DB connection from the pool. Call close() to give it back.
         """
-        return sqlite3.connect(self.filename)
+        return self.pool.connection()
 
     def context_cursor(self):
         return CMCursor(self.getDb)
 
+    def ensure_unique_index(self, table, name, columns):
+        """ Schema migration step. Creates a unique index on table(columns)
+            if it does not exist yet, deleting duplicated rows first (the most
+            recently inserted row is kept).
+                table   -- table name
+                name    -- index name
+                columns -- sequence of column names
+
+            Returns True if the index was created.
+        """
+        with self.context_cursor() as cur:
+            cur.execute("SELECT name FROM sqlite_master WHERE type='index' AND name=?", (name, ))
+            if cur.fetchone() is not None:
+                return False
+            columns = ', '.join(columns)
+            cur.execute('DELETE FROM %s WHERE rowid NOT IN (SELECT max(rowid) FROM %s GROUP BY %s)' % (table, table, columns))
+            if cur.rowcount > 0:
+                logging.info("store: deleted %d duplicated rows from %s" % (cur.rowcount, table))
+            cur.execute('CREATE UNIQUE INDEX %s ON %s (%s)' % (name, table, columns))
+            logging.info("store: created unique index %s on %s (%s)" % (name, table, columns))
+            return True
 
+    def close(self):
+        """ Close the pooled connections.
+        """
+        self.pool.close()
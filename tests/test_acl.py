@@ -0,0 +1,33 @@
+"""
+    This file is part of SleekBot. http://github.com/hgrecco/SleekBot
+    See the README file for more information.
+"""
+
+import unittest
+
+from sleekbot.acl import ACL
+
+
+class ACLTest(unittest.TestCase):
+
+    def test_unknown_jid_does_not_change_counts(self):
+        acl = ACL(None)
+        self.assertEqual(acl['nobody@example.com'], '')
+        self.assertFalse('nobody@example.com' in acl)
+        acl['nobody@example.com'] = ACL.ROLE.user
+        self.assertEqual(acl.count(), 1)
+        self.assertEqual(acl.count(ACL.ROLE.user), 1)
+        self.assertEqual(acl.count(''), 0)
+
+    def test_domain_roles(self):
+        acl = ACL(None)
+        acl['example.com'] = ACL.ROLE.user
+        acl['boss@example.com'] = ACL.ROLE.owner
+        self.assertTrue('someone@example.com' in acl.users)
+        self.assertEqual(acl.roles_of('boss@example.com'), frozenset([ACL.ROLE.user, ACL.ROLE.owner]))
+        del acl['boss@example.com']
+        self.assertEqual(acl.count(ACL.ROLE.owner), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+    This file is part of SleekBot. http://github.com/hgrecco/SleekBot
+    See the README file for more information.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from xml.etree import ElementTree as ET
+
+from sleekbot.commandbot import CommandBot
+from sleekbot.plugbot import PlugBot
+from sleekbot.store import store
+
+
+class AliasBot(PlugBot):
+    """ The parts of SleekBot used by the alias plugin.
+    """
+
+    im_prefix = '/'
+    muc_prefix = '!'
+
+    def __init__(self, path):
+        self.im_commands = {}
+        self.muc_commands = {}
+        self.freetext = []
+        self.dispatched = []
+        self.store = store(path)
+        self.botconfig = ET.fromstring("""<config><plugins><bot workers='1'>
+            <plugin name='alias'><config><alias name='r' command='rehash' /></config></plugin>
+            </bot></plugins></config>""")
+        PlugBot.__init__(self, default_package = 'sleekbot.plugins')
+
+    register_commands = CommandBot.register_commands.im_func
+    unregister_commands = CommandBot.unregister_commands.im_func
+    parse_msg = CommandBot.parse_msg.im_func
+
+    def get_real_jid(self, msg):
+        return 'user@example.com'
+
+    def dispatch_msg(self, msg):
+        self.dispatched.append(msg['body'])
+
+
+class AliasTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.bot = AliasBot(os.path.join(self.path, 'test.sqlite'))
+
+    def tearDown(self):
+        PlugBot.stop(self.bot)
+        self.bot.store.pool.close()
+        shutil.rmtree(self.path)
+
+    def test_chat_is_not_a_candidate(self):
+        self.assertEqual(self.bot.freetext_matcher.match('just chatting'), [])
+
+    def test_global_alias(self):
+        candidates = self.bot.freetext_matcher.match('!r now')
+        self.assertEqual(len(candidates), 1)
+        (f, match) = candidates[0]
+        msg = {'type': 'groupchat', 'body': '!r now'}
+        f(msg['body'], msg, False, False, match)
+        self.assertEqual(self.bot.dispatched, ['!rehash now'])
+
+
+if __name__ == '__main__':
+    unittest.main()
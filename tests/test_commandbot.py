@@ -0,0 +1,36 @@
+"""
+    This file is part of SleekBot. http://github.com/hgrecco/SleekBot
+    See the README file for more information.
+"""
+
+import unittest
+
+from sleekbot.commandbot import FreetextMatcher, botfreetxt
+
+
+def freetext_parser(regex, priority = 1):
+    @botfreetxt(priority = priority, regex = regex)
+    def parser(self, text, msg, command_found, freetext_found, match):
+        return match.group(0)
+    return parser
+
+
+class FreetextMatcherTest(unittest.TestCase):
+
+    def test_combined_prefilter(self):
+        matcher = FreetextMatcher([(1, freetext_parser('(a)b')), (2, freetext_parser('(c)d'))])
+        self.assertNotEqual(matcher.combined, None)
+        self.assertEqual(matcher.match('xyz'), [])
+        self.assertEqual([m.group(0) for (f, m) in matcher.match('xcd')], ['cd'])
+
+    def test_more_than_100_groups(self):
+        parsers = [(n, freetext_parser('(w%d)(x)' % n, n)) for n in range(120)]
+        matcher = FreetextMatcher(parsers)
+        self.assertEqual(matcher.combined, None)
+        self.assertEqual(matcher.match('nothing'), [])
+        found = matcher.match('w7x and w110x')
+        self.assertEqual([m.group(0) for (f, m) in found], ['w7x', 'w110x'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+    This file is part of SleekBot. http://github.com/hgrecco/SleekBot
+    See the README file for more information.
+"""
+
+import threading
+import unittest
+import urllib2
+
+from sleekbot.metrics import Registry
+from sleekbot.plugins.prometheus import MetricsHandler, MetricsServer, exposition
+
+
+class ExpositionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry(enabled = True)
+        sent = self.registry.counter('sleekbot_outbox_sent_total', 'Stanzas sent', ('to', ))
+        sent.inc((u'caf\xe9@conference.example.com', ))
+        sent.inc(('say "hi"\n', ), 2)
+
+    def test_non_ascii_label(self):
+        text = exposition(self.registry)
+        self.assertTrue(u'sleekbot_outbox_sent_total{to="caf\xe9@conference.example.com"} 1' in text)
+        self.assertTrue(u'sleekbot_outbox_sent_total{to="say \\"hi\\"\\n"} 2' in text)
+        self.assertTrue(text.endswith('# EOF\n'))
+
+    def test_scrape(self):
+        server = MetricsServer(('127.0.0.1', 0), MetricsHandler)
+        server.registry = self.registry
+        thread = threading.Thread(target = server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            response = urllib2.urlopen('http://127.0.0.1:%d/metrics' % server.server_address[1])
+            body = response.read()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertTrue('charset=utf-8' in response.info().getheader('Content-Type'))
+        self.assertTrue('to="caf\xc3\xa9@conference.example.com"' in body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+"""
+    This file is part of SleekBot. http://github.com/hgrecco/SleekBot
+    See the README file for more information.
+"""
+
+import unittest
+
+from sleekbot.store import WriteBehind
+
+
+class WriteBehindTest(unittest.TestCase):
+
+    def setUp(self):
+        self.written = []
+        self.buffer = WriteBehind(self.write, interval = 3600, max_pending = 1000, max_retries = 3)
+
+    def tearDown(self):
+        self.buffer.close()
+
+    def write(self, values):
+        if 'bad' in values:
+            raise ValueError('constraint failed')
+        self.written.extend(values)
+
+    def test_coalesce(self):
+        self.buffer.put('a', 1)
+        self.buffer.put('a', 2)
+        self.assertEqual(self.buffer.get('a'), 2)
+        self.buffer.flush()
+        self.assertEqual(self.written, [2])
+
+    def test_failed_value_is_dropped(self):
+        self.buffer.put('a', 'bad')
+        for n in range(2):
+            self.buffer.flush()
+            self.assertEqual(self.buffer.get('a'), 'bad')
+        self.buffer.flush()
+        self.assertEqual(self.buffer.get('a'), None)
+        self.buffer.put('b', 'good')
+        self.buffer.flush()
+        self.assertEqual(self.written, ['good'])
+
+    def test_new_value_replaces_failed_one(self):
+        self.buffer.put('a', 'bad')
+        self.buffer.flush()
+        self.buffer.put('a', 'good')
+        self.buffer.flush()
+        self.assertEqual(self.written, ['good'])
+
+
+if __name__ == '__main__':
+    unittest.main()